@@ -0,0 +1,287 @@
+# Audio worker processes.
+# The control process (app.py) keeps the gateway, the voice connections and the Music cog.
+# Audio workers run the decoders for a share of the guilds and stream the finished Opus
+# packets back over a pipe. The voice client in the control process only encrypts and sends them.
+# In pcm mode (pcm_decoder) the worker scales the volume and Opus encodes every frame, the bulk
+# of a stream's CPU in the control process otherwise. In opus mode (ffmpeg_decoder) ffmpeg does
+# that work in its own process anyway, and a worker only saves the control process reading it.
+# Voice connections can't move into the workers themselves: discord.py negotiates them over
+# the main gateway connection (VOICE_STATE_UPDATE/VOICE_SERVER_UPDATE), which only the
+# control process has.
+import itertools
+import multiprocessing
+import queue
+import threading
+import traceback
+
+import discord
+
+# Packets a worker may send ahead of what was played, 50 are one second of audio.
+BUFFER = 50
+CREDIT_BATCH = 10
+
+
+def ffmpeg_decoder(media, codec, before_options, options):
+    """The default decoder, an ffmpeg process outputting Opus."""
+    return discord.FFmpegOpusAudio(media, codec=codec, before_options=before_options, options=options)
+
+
+class PCMEncoder:
+    """ffmpeg decoding to PCM, with the volume scaled and Opus encoded here."""
+
+    def __init__(self, media, volume, before_options, options):
+        self.encoder = discord.opus.Encoder()  # First, it fails without libopus
+        self.source = discord.PCMVolumeTransformer(
+            discord.FFmpegPCMAudio(media, before_options=before_options, options=options), volume)
+
+    def read(self):
+        pcm = self.source.read()
+        return self.encoder.encode(pcm, self.encoder.SAMPLES_PER_FRAME) if pcm else b''
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+def pcm_decoder(media, volume, before_options, options):
+    """The decoder of pcm mode, doing the work the voice client would do otherwise."""
+    return PCMEncoder(media, volume, before_options, options)
+
+
+class _Stream(threading.Thread):
+    """Worker side of a stream: reads packets from its decoder as long as it has credit."""
+
+    def __init__(self, sid, decoder, args, send):
+        super().__init__(daemon=True, name=f'stream-{sid}')
+        self.sid = sid
+        self.decoder = decoder
+        self.args = args
+        self.send = send
+        self.credit = threading.Semaphore(0)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.credit.release()
+
+    def run(self):
+        source = None
+        try:
+            source = self.decoder(*self.args)
+            while True:
+                self.credit.acquire()
+                if self.closed:
+                    return
+                packet = source.read()
+                self.send(self.sid, packet)
+                if not packet:
+                    return
+        except Exception:
+            traceback.print_exc()
+            self.send(self.sid, b'')
+        finally:
+            if source is not None:
+                source.cleanup()
+
+
+def worker_main(control, data, decoder):
+    """Entry point of a worker process. Runs streams opened over control until it is closed."""
+    lock = threading.Lock()
+    streams = {}
+
+    def send(sid, packet):
+        with lock:
+            try:
+                data.send((sid, packet))
+            except OSError:
+                pass  # The control process is gone, control.recv() notices too
+
+    try:
+        while True:
+            try:
+                message = control.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+
+            op, sid, *args = message
+            if op == 'open':
+                stream = streams[sid] = _Stream(sid, decoder, args[0], send)
+                stream.credit.release(args[1])
+                stream.start()
+            elif op == 'credit':
+                stream = streams.get(sid)
+                if stream is not None:
+                    stream.credit.release(args[0])
+            elif op == 'close':
+                stream = streams.pop(sid, None)
+                if stream is not None:
+                    stream.close()
+    finally:
+        for stream in streams.values():
+            stream.close()
+        for stream in streams.values():
+            stream.join(timeout=5)
+
+
+class WorkerStream:
+    """Control side of a stream: the packets its worker sent ahead, read by the voice thread."""
+
+    def __init__(self, pool, worker, sid, guild_id):
+        self.pool = pool
+        self.worker = worker
+        self.sid = sid
+        self.guild_id = guild_id
+        self.packets = queue.SimpleQueue()
+        self.played = 0
+        self.closed = False
+
+    def read(self, timeout):
+        """The next packet, b'' at the end of the stream or if the worker stalls for timeout seconds."""
+        try:
+            packet = self.packets.get(timeout=timeout)
+        except queue.Empty:
+            return b''
+        if packet:
+            self.played += 1
+            if self.played % CREDIT_BATCH == 0:
+                self.worker.send(('credit', self.sid, CREDIT_BATCH))
+        return packet
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.close(self)
+
+
+class AudioWorker:
+    """A worker process and the thread that hands its packets to the streams they belong to."""
+
+    def __init__(self, context, index, decoder):
+        control, self._control = context.Pipe(duplex=False)
+        self._data, data = context.Pipe(duplex=False)
+        self.process = context.Process(target=worker_main, args=(control, data, decoder),
+                                       name=f'audio-worker-{index}', daemon=True)
+        self.process.start()
+        # Only the worker may hold these ends, so either side sees EOF when the other exits
+        control.close()
+        data.close()
+
+        self.index = index
+        self.streams = {}  # Stream id -> WorkerStream
+        self.alive = True
+        self._lock = threading.Lock()
+        threading.Thread(target=self._read, daemon=True,
+                         name=f'audio-worker-{index}-reader').start()
+
+    @property
+    def load(self):
+        return len(self.streams)
+
+    def send(self, message):
+        with self._lock:
+            try:
+                self._control.send(message)
+            except OSError:
+                self.alive = False
+
+    def _read(self):
+        try:
+            while True:
+                sid, packet = self._data.recv()
+                stream = self.streams.get(sid)
+                if stream is not None:
+                    stream.packets.put(packet)
+        except (EOFError, OSError):
+            pass
+        # The worker died, end its streams. Players resume them elsewhere.
+        self.alive = False
+        for stream in list(self.streams.values()):
+            stream.packets.put(b'')
+
+    def stop(self):
+        self.send(None)
+
+
+class AudioWorkerPool:
+    """Spreads the streams of guilds over count worker processes with room for capacity streams each.
+    A guild stays on its worker while it has streams there, so the next song's stream
+    starts next to the current one. New guilds go to the least loaded worker, and a
+    guild whose worker is full moves to the least loaded one with its next stream.
+    """
+
+    def __init__(self, count, capacity, decoder=ffmpeg_decoder):
+        self.count = count
+        self.capacity = capacity
+        self.decoder = decoder
+        self.workers = []
+        self.assigned = {}  # Guild id -> AudioWorker
+        # Streams are closed on the voice threads, guards assigned and the streams of the workers
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._started = itertools.count()
+
+        self.opened = 0
+        self.moves = 0
+        self.restarts = 0
+
+    def _alive(self):
+        """The running workers, replacing dead ones and starting the first ones on demand."""
+        context = multiprocessing.get_context('spawn')
+        for i, worker in enumerate(self.workers):
+            if not worker.alive or not worker.process.is_alive():
+                self.workers[i] = AudioWorker(
+                    context, next(self._started), self.decoder)
+                self.restarts += 1
+        while len(self.workers) < self.count:
+            self.workers.append(AudioWorker(
+                context, next(self._started), self.decoder))
+        return self.workers
+
+    def _pick(self, guild_id, workers):
+        current = self.assigned.get(guild_id)
+        if current in workers and current.load < self.capacity:
+            return current
+
+        least = min(workers, key=lambda worker: worker.load)
+        if least.load >= self.capacity:
+            return None
+        if current is not None:
+            self.moves += 1
+        self.assigned[guild_id] = least
+        return least
+
+    def open(self, guild_id, args):
+        """Start decoding decoder(*args) for a guild. Returns a WorkerStream, None when all workers are full."""
+        workers = self._alive()  # Outside the lock, starting a worker takes a while
+        with self._lock:
+            worker = self._pick(guild_id, workers)
+            if worker is None:
+                return None
+            sid = next(self._ids)
+            stream = worker.streams[sid] = WorkerStream(
+                self, worker, sid, guild_id)
+        worker.send(('open', sid, args, BUFFER))
+        self.opened += 1
+        return stream
+
+    def close(self, stream):
+        worker = stream.worker
+        with self._lock:
+            if worker.streams.pop(stream.sid, None) is None:
+                return
+            if (self.assigned.get(stream.guild_id) is worker
+                    and not any(s.guild_id == stream.guild_id for s in worker.streams.values())):
+                del self.assigned[stream.guild_id]
+        worker.send(('close', stream.sid))
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def stats(self):
+        if not self.workers:
+            return "not started"
+        loads = " | ".join(f"#{w.index} pid {w.process.pid}: {w.load}/{self.capacity}"
+                           + ("" if w.alive else " (dead)") for w in self.workers)
+        return f"{loads}\nstreams opened: {self.opened} | guilds moved: {self.moves} | workers restarted: {self.restarts}"
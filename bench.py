@@ -0,0 +1,566 @@
+# Offline benchmarks for the music pipeline.
+# Drives Music, MusicPlayer and YTDLSource with a fake YoutubeDL and a fake voice client,
+# so no Discord gateway, YouTube or ffmpeg is needed. Results are printed as JSON,
+# compare them between commits:
+#   python bench.py -o before.json
+#   python bench.py --latency 0.05 --playlist 200
+#   python bench.py --audio-workers 4    # songs are decoded by audio worker processes
+# --ffmpeg-streams is the exception, it plays a real file through ffmpeg in each audio mode
+# and reports the CPU per stream (needs ffmpeg, and libopus for pcm mode):
+#   python bench.py --ffmpeg-streams 8 --media song.webm --seconds 30
+#   python bench.py --ffmpeg-streams 8 --media song.webm --audio-workers 2   # with and without workers
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import discord
+
+# The caches must not touch the real ones, and nothing may be downloaded.
+_tmp = tempfile.mkdtemp(prefix='bench-')
+os.environ.update(resolve_cache_path=os.path.join(_tmp, 'resolve.sqlite3'),
+                  audio_cache_dir=os.path.join(_tmp, 'downloads'),
+                  audio_cache_size_mb='0', extract_backend='thread', metrics='0', live_np='0')
+
+from cogs import music  # noqa: E402
+
+
+class FakeYoutubeDL:
+    """Stands in for YoutubeDL. Every extraction sleeps latency seconds, URLs with list= are
+    playlists of playlist_size songs, anything else is a single song.
+    """
+
+    def __init__(self, latency=0.0, playlist_size=50):
+        self.latency = latency
+        self.playlist_size = playlist_size
+        self.calls = 0
+
+    def _song(self, key):
+        return {'_type': 'video', 'id': key, 'title': f'Song {key}', 'duration': 120 + hash(key) % 240,
+                'webpage_url': f'https://www.youtube.com/watch?v={key}',
+                'thumbnail': f'https://i.ytimg.com/vi/{key}/hqdefault.jpg'}
+
+    def _stream(self, info):
+        expire = int(time.time()) + 6 * 3600
+        return dict(info, url=f"https://example.invalid/{info['id']}?expire={expire}",
+                    acodec='opus', abr=128, format='251 - audio only')
+
+    def extract_info(self, url, download=False, process=True, ie_key=None):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if 'list=' in url:
+            key = url.rsplit('list=', 1)[1]
+            entries = ({'_type': 'url', 'ie_key': 'Youtube', 'id': f'{key}-{i}', 'url': f'{key}-{i}',
+                        'title': f'Song {key}-{i}', 'duration': 120 + i % 240}
+                       for i in range(self.playlist_size))
+            return {'_type': 'playlist', 'title': f'Playlist {key}', 'webpage_url': url,
+                    'extractor_key': 'YoutubeTab', 'entries': entries}
+        key = url.rsplit('v=', 1)[1] if 'v=' in url else url.replace(' ', '-')
+        info = self._song(key)
+        return self._stream(info) if process else info
+
+    def process_ie_result(self, info, download=False):
+        return self._stream(info)
+
+    def get_info_extractor(self, key):
+        return None
+
+
+class FakeSource(music.SongSource, discord.AudioSource):
+    """A source without an ffmpeg process behind it."""
+
+    def __init__(self, media, *, data, requester, start=0):
+        self._init_song(data, requester, media, start)
+
+    def read(self):
+        self.frames += 1
+        return b'\xf8\xff\xfe'
+
+
+def _from_media(cls, media, *, data, requester, volume=1.0, start=0):
+    return FakeSource(media, data=data, requester=requester, start=start)
+
+
+OPUS_SILENCE = b'\xf8\xff\xfe'
+
+
+class FakeDecoder:
+    """Stands in for ffmpeg in the audio workers: ten seconds of Opus silence."""
+
+    def __init__(self, media, codec, before_options, options):
+        self.left = 500
+
+    def read(self):
+        if not self.left:
+            return b''
+        self.left -= 1
+        return OPUS_SILENCE
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    """Records when songs start, ending a song calls the after callback like the real audio thread.
+    With realtime a thread reads the source every 20 ms and a song starts with its first packet.
+    """
+
+    realtime = False
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.channel = None
+        self.source = None
+        self._after = None
+        self._paused = False
+        self._stopped = None
+        self.loop = asyncio.get_event_loop()
+        self.started = asyncio.Event()
+        self.started_at = None
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self.source is not None and not self._paused
+
+    def is_paused(self):
+        return self.source is not None and self._paused
+
+    def play(self, source, *, after=None):
+        self.source = source
+        self._after = after
+        self._paused = False
+        if not self.realtime:
+            self.started_at = time.perf_counter()
+            self.started.set()
+            return
+        self._stopped = threading.Event()
+        threading.Thread(target=self._send, args=(
+            source, self._stopped), daemon=True).start()
+
+    def _send(self, source, stopped):
+        first = True
+        while not stopped.is_set():
+            packet = source.read()
+            if not packet:
+                break
+            if first:
+                first = False
+                self.started_at = time.perf_counter()
+                self.loop.call_soon_threadsafe(self.started.set)
+            time.sleep(0.02)
+        if not stopped.is_set():
+            self.stop()
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def stop(self):
+        # Like discord.py's audio player, the source is cleaned up before after is called
+        if self._stopped is not None:
+            self._stopped.set()
+        after, self._after = self._after, None
+        source, self.source = self.source, None
+        if source is not None:
+            source.cleanup()
+        if after is not None:
+            after(None)
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.guild.voice_client = None
+
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.id = random.getrandbits(63)
+        self.channel = channel
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, id):
+        self.id = id
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self)
+
+
+class FakeMember:
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id
+        self.mention = f'<@{guild.id}>'
+        self.display_name = f'user{guild.id}'
+        self.avatar_url = ''
+        self.bot = False
+
+    def __str__(self):
+        return self.display_name
+
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+        self.name = f'guild{id}'
+        self.voice_client = FakeVoiceClient(self)
+
+
+class FakeBot:
+    """What MusicPlayer and Music use of commands.Bot."""
+
+    def __init__(self, ready=True):
+        self.loop = asyncio.get_event_loop()
+        self.user = None
+        self._ready = asyncio.Event()
+        if ready:
+            self._ready.set()
+
+    async def wait_until_ready(self):
+        await self._ready.wait()
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def is_closed(self):
+        return False
+
+
+class FakeContext:
+    def __init__(self, bot, cog, guild):
+        self.bot = bot
+        self.cog = cog
+        self.guild = guild
+        self.channel = FakeChannel(guild.id)
+        self.author = FakeMember(guild)
+        self.message = FakeMessage(self.channel)
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def trigger_typing(self):
+        pass
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command.callback(self.cog, self, *args, **kwargs)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def _rate(func, count):
+    started = time.perf_counter()
+    func()
+    return round(count / (time.perf_counter() - started))
+
+
+def bench_queue_ops(size):
+    """Operations per second of the TrackQueue primitives on a queue of size songs."""
+    requester = FakeMember(FakeGuild(0))
+    tracks = [music.Track(f'https://www.youtube.com/watch?v={i % (size // 2 or 1)}', f'Song {i}', requester, 200)
+              for i in range(size)]
+    queue = music.TrackQueue()
+    results = {}
+
+    results['put'] = _rate(lambda: [queue.put(track) for track in tracks], size)
+    results['head'] = _rate(lambda: [queue.head for _ in range(size)], size)
+    moves = [(random.randrange(size), random.randrange(size)) for _ in range(1000)]
+    results['move'] = _rate(lambda: [queue.move(i, to) for i, to in moves], len(moves))
+    results['shuffle'] = _rate(lambda: [queue.shuffle() for _ in range(10)], 10)
+    results['dedupe'] = _rate(queue.dedupe, 1)
+    results['pop_front'] = _rate(lambda: [queue.pop(0) for _ in range(len(queue))], len(queue) or 1)
+    results['extend'] = _rate(lambda: queue.extend(tracks), size)
+    results['clear'] = _rate(queue.clear, 1)
+    return {'size': size, 'ops_per_second': results}
+
+
+def bench_queue_render(cog, bot, sizes, repeat=20):
+    """Cost of rendering the first and the last !queue page, uncached and cached."""
+    results = []
+    for size in sizes:
+        guild = FakeGuild(10**6 + size)
+        ctx = FakeContext(bot, cog, guild)
+        player = cog.get_player(ctx)
+        player.queue.extend(music.Track(f'https://www.youtube.com/watch?v={i}', f'Song {i}', ctx.author,
+                                      None if i % 10 == 0 else 200) for i in range(size))
+        last = max(1, -(-size // music.QUEUE_PAGE_SIZE))
+
+        row = {'size': size}
+        for name, page in (('first_page_ms', 1), ('last_page_ms', last)):
+            timings = []
+            for _ in range(repeat):
+                player.pages = (None, {})
+                started = time.perf_counter()
+                cog._queue_page(player, page)
+                timings.append(time.perf_counter() - started)
+            row[name] = _ms(statistics.median(timings))
+        started = time.perf_counter()
+        for _ in range(repeat):
+            cog._queue_page(player, last)
+        row['cached_ms'] = _ms((time.perf_counter() - started) / repeat)
+        results.append(row)
+
+        player.teardown()
+        del cog.players[guild.id]
+    return results
+
+
+async def _until(predicate, limit=30):
+    deadline = time.perf_counter() + limit
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError('benchmark stalled')
+        await asyncio.sleep(0.001)
+
+
+async def bench_transitions(cog, bot, guilds, songs, play_time):
+    """Time from the end of a song to the start of the next, with guilds playing at once."""
+    gaps = []
+
+    async def run(gid):
+        guild = FakeGuild(gid)
+        ctx = FakeContext(bot, cog, guild)
+        vc = guild.voice_client
+        for i in range(songs):
+            await cog.play_.callback(cog, ctx, search=f'https://www.youtube.com/watch?v=t{gid}-{i}')
+        player = cog.players[gid]
+        await vc.started.wait()
+        for _ in range(songs - 1):
+            await asyncio.sleep(play_time)
+            vc.started.clear()
+            ended = time.perf_counter()
+            player.stop()
+            await vc.started.wait()
+            gaps.append(vc.started_at - ended)
+        await cog.cleanup(guild)
+
+    await asyncio.gather(*(run(2 * 10**6 + i) for i in range(guilds)))
+    gaps.sort()
+    return {'guilds': guilds, 'songs': songs, 'play_time_s': play_time, 'transitions': len(gaps),
+            'mean_ms': _ms(statistics.mean(gaps)), 'p50_ms': _ms(gaps[len(gaps) // 2]),
+            'p95_ms': _ms(gaps[int(len(gaps) * .95)]), 'max_ms': _ms(gaps[-1])}
+
+
+async def bench_memory(cog, bot, counts, playlist_size):
+    """Traced Python memory per guild with a player that plays a queued playlist."""
+    results = []
+    for count in counts:
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        guilds = [FakeGuild(3 * 10**6 + count * 10 + i) for i in range(count)]
+        for guild in guilds:
+            ctx = FakeContext(bot, cog, guild)
+            await cog.play_.callback(cog, ctx, search=f'https://www.youtube.com/playlist?list=m{count}-{guild.id}')
+        await _until(lambda: all(cog.players[g.id].current is not None
+                                 and len(cog.players[g.id].queue) == playlist_size - 1 for g in guilds))
+
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        results.append({'guilds': count, 'bytes_per_guild': used // count})
+
+        for guild in guilds:
+            await cog.cleanup(guild)
+    return results
+
+
+class _Reader(threading.Thread):
+    """Reads a source like the voice client's audio thread, minus the network: one frame
+    every 20 ms, Opus encoded here when the source gives PCM.
+    """
+
+    def __init__(self, source, seconds):
+        super().__init__(daemon=True)
+        self.source = source
+        self.seconds = seconds
+        self.frames = 0
+        self.late = 0  # Frames that weren't ready in time
+        self.encoder = None if source.is_opus() else discord.opus.Encoder()
+
+    def run(self):
+        encoder = self.encoder
+        started = time.perf_counter()
+        for i in range(int(self.seconds / 0.02)):
+            data = self.source.read()
+            if not data:
+                break
+            if encoder is not None:
+                encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+            self.frames += 1
+            delay = started + (i + 1) * 0.02 - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.late += 1
+
+
+def _cpu_share(seconds, wall, streams):
+    return round(seconds / wall / streams, 4)
+
+
+async def bench_ffmpeg(media, streams, seconds, volume, workers=0):
+    """Play streams copies of media for seconds in each audio mode, with real ffmpeg processes,
+    and with workers also through that many audio worker processes.
+    CPU is given per stream as a share of one core: for this process (reading, and the volume
+    and Opus encoding in pcm mode without workers), for each ffmpeg and for the workers.
+    """
+    data = {'title': os.path.basename(media), 'webpage_url': media, 'duration': None,
+            # What YouTube reports for its Opus formats, to allow the remux in opus mode
+            'acodec': 'opus' if media.endswith(('.opus', '.webm', '.ogg')) else None}
+    music.supervisor.max_processes = 0
+    results = {}
+    for mode, count in [('opus', 0), ('pcm', 0)] + ([('opus', workers), ('pcm', workers)] if workers else []):
+        name = f'{mode}+{count} workers' if count else mode
+        music.AUDIO_MODE = mode
+        pool = music.audio_workers = music._worker_pool(count, streams)
+        sources = []
+        music.supervisor.live_sources = lambda: sources
+        try:
+            for _ in range(streams):
+                sources.append(music.YTDLSource.from_media(media, data=dict(data), requester=None, volume=volume))
+            readers = [_Reader(source, seconds) for source in sources]
+            # The first frames wait for ffmpeg and the workers to start, that isn't measured
+            if not all(source.read() for source in sources):
+                raise discord.ClientException('A stream ended before its first frame, see the output above.')
+            pids = [w.process.pid for w in pool.workers] or [
+                music.FFmpegSupervisor._process(source).pid for source in sources]
+            before = [music.FFmpegSupervisor.usage(pid) for pid in pids]
+            cpu, wall = time.process_time(), time.perf_counter()
+            for reader in readers:
+                reader.start()
+            for reader in readers:
+                reader.join()
+            cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+            after = [music.FFmpegSupervisor.usage(pid) for pid in pids]
+        except (discord.ClientException, discord.opus.OpusNotLoaded) as e:
+            results[name] = {'error': str(e) or type(e).__name__}
+            continue
+        finally:
+            for source in sources:
+                source.cleanup()
+            pool.shutdown()
+
+        # ffmpeg runs inside the workers with them, the worker figures include its reading only
+        usage = [(a[0] - b[0], a[1]) for b, a in zip(before, after) if a is not None and b is not None]
+        children = 'worker' if count else 'ffmpeg'
+        results[name] = {
+            'streams': streams, 'seconds': round(wall, 2),
+            'frames': sum(r.frames for r in readers), 'late_frames': sum(r.late for r in readers),
+            'control_cpu_per_stream': _cpu_share(cpu, wall, streams),
+            f'{children}_cpu_per_stream': _cpu_share(sum(u[0] for u in usage), wall, streams) if usage else None,
+            f'{children}_rss_mib': round(statistics.mean(u[1] for u in usage) / 2**20, 1) if usage else None}
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def main(args):
+    if args.ffmpeg_streams:
+        return {'commit': _commit(), 'python': platform.python_version(),
+                'params': {'media': args.media, 'seconds': args.seconds, 'volume': args.volume,
+                           'audio_workers': args.audio_workers},
+                'ffmpeg': await bench_ffmpeg(args.media, args.ffmpeg_streams, args.seconds, args.volume,
+                                             args.audio_workers)}
+
+    fake = FakeYoutubeDL(args.latency, args.playlist)
+    music._ytdl = lambda: fake
+    if args.audio_workers:
+        music.audio_workers = music.AudioWorkerPool(
+            args.audio_workers, args.worker_capacity, decoder=FakeDecoder)
+    else:
+        music.YTDLSource.from_media = classmethod(_from_media)
+    if not args.pace:
+        # Channel pacing would dominate the transitions, Discord's side isn't simulated here.
+        music.outbound.rate = 10**9
+
+    results = {'commit': _commit(), 'python': platform.python_version(),
+               'params': {'latency_s': args.latency, 'playlist': args.playlist, 'audio_mode': music.AUDIO_MODE,
+                          'audio_workers': args.audio_workers}}
+
+    results['queue_ops'] = bench_queue_ops(args.queue_size)
+    # A bot that never becomes ready, so the players don't consume their queues
+    idle = FakeBot(ready=False)
+    results['queue_render'] = bench_queue_render(music.Music(idle), idle, args.render_sizes)
+
+    bot = FakeBot()
+    cog = music.Music(bot)
+    # With audio workers a song starts with its first packet, after a round trip through a worker
+    FakeVoiceClient.realtime = bool(args.audio_workers)
+    results['transitions'] = await bench_transitions(cog, bot, args.transition_guilds, args.songs, args.play_time)
+    FakeVoiceClient.realtime = False
+    results['memory'] = await bench_memory(cog, bot, args.guilds, args.playlist)
+    results['extractions'] = fake.calls
+    if args.audio_workers:
+        results['audio_workers'] = music.audio_workers.stats()
+        music.audio_workers.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the music pipeline.')
+    parser.add_argument('-o', '--output', help='write the JSON here instead of stdout')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per fake extraction')
+    parser.add_argument('--playlist', type=int, default=20, help='songs per fake playlist')
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--render-sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--transition-guilds', type=int, default=10)
+    parser.add_argument('--songs', type=int, default=10, help='songs per guild in the transition benchmark')
+    parser.add_argument('--play-time', type=float, default=0.02, help='seconds each song plays')
+    parser.add_argument('--guilds', type=int, nargs='+', default=[1, 100, 1000])
+    parser.add_argument('--pace', action='store_true', help='keep the per channel message pacing')
+    parser.add_argument('--audio-workers', type=int, default=0, help='decode in this many worker processes')
+    parser.add_argument('--worker-capacity', type=int, default=2000, help='streams per audio worker')
+    parser.add_argument('--ffmpeg-streams', type=int, default=0,
+                        help='only measure the CPU of this many real ffmpeg streams per audio mode')
+    parser.add_argument('--media', help='file or URL played by --ffmpeg-streams')
+    parser.add_argument('--seconds', type=float, default=10, help='seconds each --ffmpeg-streams run plays')
+    parser.add_argument('--volume', type=float, default=.5,
+                        help='volume of --ffmpeg-streams, players start at 0.5, 1.0 allows remuxing Opus')
+    args = parser.parse_args()
+    if args.ffmpeg_streams and not args.media:
+        parser.error('--ffmpeg-streams needs --media')
+
+    results = asyncio.run(main(args))
+    music.scheduler._executor.shutdown(wait=False)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    sys.exit(0)
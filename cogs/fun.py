@@ -0,0 +1,342 @@
+# Fun commands: random cats, memes and quotes from external APIs, and !hack.
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+import aiohttp
+import discord
+from discord.ext import commands
+
+from outbound import outbound, copy_embed
+
+
+class UpstreamError(commands.CommandError):
+    """Exception for when an external API can't be reached."""
+
+
+class HTTPClient:
+    """Shared HTTP client for the commands calling external APIs.
+    Connections are pooled, every request has a timeout and is retried with backoff,
+    and each host has a circuit breaker: after threshold failed requests in a row it
+    isn't contacted for cooldown seconds. Latencies are recorded per endpoint.
+    """
+
+    def __init__(self, *, timeout=5, retries=2, threshold=5, cooldown=60, limit=20):
+        self.timeout = timeout
+        self.retries = retries
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.limit = limit
+
+        self._session = None
+        self._failures = {}  # host -> failed requests in a row
+        self._open_until = {}  # host -> time the breaker closes again
+        self.latencies = {}  # endpoint -> recent latencies in seconds
+        self.errors = {}  # endpoint -> failed attempts
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                                  connector=aiohttp.TCPConnector(limit=self.limit, ttl_dns_cache=300))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_json(self, url):
+        """GET url and return its decoded JSON body. Raises UpstreamError when it can't."""
+        parts = urlparse(url)
+        host, endpoint = parts.netloc, parts.netloc + parts.path
+        if self._open_until.get(host, 0) > time.time():
+            raise UpstreamError(f'{host} is unavailable right now.')
+
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                async with self.session().get(url) as r:
+                    r.raise_for_status()
+                    data = await r.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+                error = e
+                if attempt < self.retries:
+                    await asyncio.sleep(0.25 * 2 ** attempt)
+                continue
+
+            self.latencies.setdefault(endpoint, deque(maxlen=512)).append(
+                time.perf_counter() - started)
+            self._failures[host] = 0
+            return data
+
+        self._failures[host] = self._failures.get(host, 0) + 1
+        if self._failures[host] >= self.threshold:
+            self._open_until[host] = time.time() + self.cooldown
+        raise UpstreamError(f'{host} is unavailable right now.') from error
+
+    def stats(self):
+        lines = []
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            samples = sorted(self.latencies.get(endpoint, ()))
+            if samples:
+                def pick(q): return samples[min(int(q * len(samples)), len(samples) - 1)] * 1000
+                timing = f"p50 {pick(.5):.0f} ms | p90 {pick(.9):.0f} ms | p99 {pick(.99):.0f} ms"
+            else:
+                timing = "no successful requests"
+            host = endpoint.split('/', 1)[0]
+            breaker = " | circuit open" if self._open_until.get(
+                host, 0) > time.time() else ""
+            lines.append(
+                f"{endpoint}: {timing} | errors {self.errors.get(endpoint, 0)}{breaker}")
+        return "\n".join(lines) or "no requests yet"
+
+
+http = HTTPClient(timeout=float(os.getenv('http_timeout', 5)),
+                  retries=int(os.getenv('http_retries', 2)))
+
+
+class ContentPool:
+    """Buffer of ready to send items from an external API, refilled in the background.
+    A refill starts when fewer than low items are left and runs until there are high.
+    Items shown recently are skipped, and when the API is down a recently shown item
+    is sent again rather than nothing.
+    """
+
+    def __init__(self, name, fetch, *, low=3, high=10, recent=100):
+        self.name = name
+        self.fetch = fetch  # Coroutine function returning a list of items
+        self.low = low
+        self.high = high
+
+        self._items = deque()
+        self._recent = deque(maxlen=recent)
+        self._refill = None
+
+        self.served = 0
+        self.waited = 0
+        self.fallbacks = 0
+
+    def _add(self, items):
+        added = 0
+        for item in items:
+            if item and item not in self._recent and item not in self._items:
+                self._items.append(item)
+                added += 1
+        return added
+
+    def start(self):
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.get_event_loop().create_task(self._refill_loop())
+
+    def stop(self):
+        if self._refill is not None:
+            self._refill.cancel()
+            self._refill = None
+
+    async def _refill_loop(self):
+        stale = 0
+        while len(self._items) < self.high and stale < 3:
+            try:
+                added = self._add(await self.fetch())
+            except UpstreamError:
+                return
+            # Stop when the API keeps repeating what we already have
+            stale = 0 if added else stale + 1
+
+    async def get(self):
+        """Return the next item. Raises UpstreamError if there is nothing at all to send."""
+        if not self._items:
+            self.waited += 1
+            try:
+                self._add(await self.fetch())
+            except UpstreamError:
+                if not self._recent:
+                    raise
+                self.fallbacks += 1
+                return random.choice(self._recent)
+            if not self._items:
+                if not self._recent:
+                    raise UpstreamError(f'No {self.name} available right now.')
+                self.fallbacks += 1
+                return random.choice(self._recent)
+
+        item = self._items.popleft()
+        self._recent.append(item)
+        self.served += 1
+        if len(self._items) < self.low:
+            self.start()
+        return item
+
+    def stats(self):
+        return (f"{self.name}: {len(self._items)} ready | served {self.served} | "
+                f"had to wait {self.waited} | fallbacks {self.fallbacks}")
+
+
+# The fetchers raise UpstreamError for bodies that aren't shaped as expected too,
+# anything else would end the refill task of their pool.
+async def _fetch_cats():
+    data = await http.get_json('https://aws.random.cat/meow')
+    if not isinstance(data, dict):
+        raise UpstreamError('aws.random.cat sent an unexpected response.')
+    return [data.get('file')]
+
+
+async def _fetch_memes():
+    data = await http.get_json('https://meme-api.herokuapp.com/gimme/memes/10')
+    if not isinstance(data, dict) or not isinstance(data.get('memes', []), list):
+        raise UpstreamError('meme-api.herokuapp.com sent an unexpected response.')
+    return [meme.get('url') for meme in data.get('memes', []) if isinstance(meme, dict)]
+
+
+async def _fetch_quotes():
+    # A batch of 50 random quotes
+    data = await http.get_json('https://zenquotes.io/api/quotes')
+    if not isinstance(data, list):
+        raise UpstreamError('zenquotes.io sent an unexpected response.')
+    return [(quote.get('q'), quote.get('a')) for quote in data if isinstance(quote, dict) and quote.get('q')]
+
+
+_low, _high = int(os.getenv('content_buffer_low', 3)), int(
+    os.getenv('content_buffer_high', 10))
+cats = ContentPool('cats', _fetch_cats, low=_low, high=_high)
+memes = ContentPool('memes', _fetch_memes, low=_low, high=_high)
+quotes = ContentPool('quotes', _fetch_quotes, low=_low, high=_high)
+content_pools = (cats, memes, quotes)
+
+
+async def _upstream_error(ctx, error):
+    embed = discord.Embed(
+        title="Error!", description=f"{error} Try again later.", color=discord.Color.red())
+    await ctx.send(embed=embed)
+
+
+# ANCHOR CAT
+@commands.command(name='cat', aliases=['kitty'], description="sends a random cat image")
+async def cat_(ctx):
+    """Send a random cat image."""
+    try:
+        image = await cats.get()
+    except UpstreamError as e:
+        return await _upstream_error(ctx, e)
+
+    embed = discord.Embed(
+        title="MEOW", description="", color=discord.Color.green())
+    embed.set_image(url=image)
+    await ctx.send(embed=embed)
+
+
+# ANCHOR MEME
+@commands.command(name='meme', description="sends a random meme")
+async def meme_(ctx):
+    """Send a random meme"""
+
+    if ctx.channel.id != 997092433047343114:
+        embed = discord.Embed(
+            title="Error!", description="This command is only available in the <#997092433047343114> channel", color=discord.Color.red())
+        await ctx.send(embed=embed)
+        return
+
+    try:
+        image = await memes.get()
+    except UpstreamError as e:
+        return await _upstream_error(ctx, e)
+
+    embed = discord.Embed(
+        title="MEME", description="", color=discord.Color.green())
+    embed.set_image(url=image)
+    await ctx.send(embed=embed)
+
+
+# ANCHOR QUOTE
+@commands.command(name='quote', aliases=['quotes'], description="sends a random quote")
+async def quote_(ctx):
+    """Send a random quote"""
+
+    if ctx.channel.id != 997169441592840303:
+        embed = discord.Embed(
+            title="Error!", description="This command is only available in the <#997169441592840303> channel", color=discord.Color.red())
+        await ctx.send(embed=embed)
+        return
+
+    try:
+        text, author = await quotes.get()
+    except UpstreamError as e:
+        return await _upstream_error(ctx, e)
+
+    embed = discord.Embed(
+        title="QUOTE", description=f"“{text}” — {author} ", color=discord.Color.green())
+    await ctx.send(embed=embed)
+
+
+HECKER_EMBED = discord.Embed(title="Starting hacking",
+                             description="hecker#8499", color=0x645034)
+HECKER_EMBED.set_author(
+    name="HECKER", icon_url="https://static.wikia.nocookie.net/beluga/images/9/9c/Hecker.jpg/revision/latest?cb=20210904163641")
+HECKER_EMBED.add_field(name="HACKING PROGRESS",
+                       value="|>         | 0%", inline=True)
+HECKER_EMBED.set_footer(text="i'm always watching")
+
+
+@commands.command(name='hack', description="calls hecker to hack someone")
+@commands.has_permissions(manage_nicknames=True)
+async def hecker_(ctx, *, user: discord.Member):
+    """Calls hecker to hack someone"""
+
+    msg = await outbound.send(ctx.channel, embed=HECKER_EMBED)
+    await asyncio.sleep(0.5)
+
+    # The edits go through outbound, a busy channel only gets the latest progress
+    for i in range(1, 11):
+        equals = "=" * i
+        progress = i * 10
+        embed = copy_embed(HECKER_EMBED)
+        embed.set_field_at(0, name="HACKING PROGRESS",
+                           value=f"|{equals}>         | {progress}%", inline=True)
+        edited = outbound.edit(msg, embed=embed)
+        await asyncio.sleep(0.5)
+
+    await edited
+    await asyncio.sleep(0.5)
+    embed = copy_embed(HECKER_EMBED)
+    embed.set_field_at(0, name="HACKING PROGRESS",
+                       value="|==========> | 100%", inline=True)
+    embed.add_field(name="HACKING COMPLETE",
+                    value=f"{user.mention} has been hacked", inline=False)
+    await outbound.send(ctx.channel, embed=embed)
+    await user.edit(nick="IM A BAD PERSON")
+
+
+COMMANDS = (cat_, meme_, quote_, hecker_)
+
+
+async def _start_pools():
+    for pool in content_pools:
+        pool.start()
+
+
+def stats_fields(bot):
+    """The fields this extension adds to !stats."""
+    return [("HTTP", http.stats()[:1024]),
+            ("Content buffers", "\n".join(pool.stats() for pool in content_pools))]
+
+
+def setup(bot):
+    for command in COMMANDS:
+        bot.add_command(command)
+    bot.add_listener(_start_pools, 'on_ready')
+    if bot.is_ready():
+        bot.loop.create_task(_start_pools())
+
+
+def teardown(bot):
+    for command in COMMANDS:
+        bot.remove_command(command.name)
+    bot.remove_listener(_start_pools, 'on_ready')
+    # Also runs when the bot closes, which unloads every extension
+    for pool in content_pools:
+        pool.stop()
+    bot.loop.create_task(http.close())
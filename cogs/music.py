@@ -0,0 +1,2477 @@
+# Music: YTDL extraction and caching, audio sources and the per guild players.
+import asyncio
+import copy
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from urllib.parse import urlparse, parse_qs
+
+import discord
+from async_timeout import timeout
+from discord.ext import commands
+
+from audio_worker import AudioWorkerPool, ffmpeg_decoder, pcm_decoder
+from metrics import metrics, SECONDS
+from outbound import outbound, copy_embed
+
+ytdlopts = {
+    'format': 'bestaudio/best',
+    'outtmpl': 'downloads/%(extractor)s-%(id)s-%(title)s.%(ext)s',
+    'restrictfilenames': True,
+    'noplaylist': False,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0'  # ipv6 addresses cause issues sometimes
+}
+
+ffmpegopts = {
+    'before_options': '-nostdin',
+    'options': '-vn'
+}
+
+youtube_dl = None  # Imported on first use, see _youtube_dl()
+
+
+def _youtube_dl():
+    """Import youtube_dl, the slowest import of the bot, when it is first needed instead of at startup."""
+    global youtube_dl
+    if youtube_dl is None:
+        import youtube_dl as module
+        # Suppress noise about console usage from errors
+        module.utils.bug_reports_message = lambda: ''
+        youtube_dl = module
+    return youtube_dl
+
+
+# Each extraction thread gets its own YoutubeDL, worker processes have a single one.
+_local = threading.local()
+_worker_ytdl = None
+
+
+def _ytdl():
+    if _worker_ytdl is not None:
+        return _worker_ytdl
+    instance = getattr(_local, 'ytdl', None)
+    if instance is None:
+        instance = _local.ytdl = _youtube_dl().YoutubeDL(ytdlopts)
+    return instance
+
+
+def _warm_up():
+    """Load youtube_dl and the extractors used the most, so the first !play doesn't wait for it."""
+    ytdl = _worker_ytdl or _ytdl()
+    ytdl.get_info_extractor('Youtube')
+    ytdl.get_info_extractor('YoutubeTab')
+
+
+def _init_worker():
+    """Set up an extraction worker process with a warmed up extractor."""
+    global _worker_ytdl
+    _worker_ytdl = _youtube_dl().YoutubeDL(ytdlopts)
+    _warm_up()
+
+
+def _entry_url(entry):
+    """Return the webpage URL of a playlist entry, which may not have been resolved yet."""
+    if entry.get('webpage_url'):
+        return entry['webpage_url']
+    url = entry.get('url') or entry.get('id')
+    if entry.get('ie_key') == 'Youtube' and not url.startswith('http'):
+        return f'https://www.youtube.com/watch?v={url}'
+    return url
+
+
+def _slim_entry(entry):
+    url = _entry_url(entry)
+    # Flat entries of some extractors (e.g. SoundCloud sets) have no title until resolved
+    return {'title': entry.get('title') or url, 'webpage_url': url,
+            'duration': entry.get('duration')}
+
+
+def _slim_info(data):
+    """Keep only the fields of a YTDL info dict the bot actually uses."""
+    info = {key: data.get(key)
+            for key in ('title', 'webpage_url', 'duration', 'thumbnail')}
+    if 'entries' in data:
+        info['entries'] = [_slim_entry(entry)
+                           for entry in data['entries'] if entry]
+    return info
+
+
+def _extract_unprocessed(search):
+    ytdl = _ytdl()
+    info = ytdl.extract_info(search, download=False, process=False)
+    for _ in range(3):
+        if info.get('_type') != 'url':
+            break
+        info = ytdl.extract_info(info['url'], download=False, process=False,
+                                 ie_key=info.get('ie_key'))
+    return info
+
+
+def _take(iterator, count):
+    return [entry for entry in itertools.islice(iterator, count) if entry]
+
+
+# Everything below returns plain dicts, so it can run in a worker process.
+def _extract_head(search):
+    """Extract a search or URL without expanding playlists.
+    Returns (data, entries). A playlist's data only holds its first entry, entries is an
+    iterator over the remaining raw entries, which YTDL fetches page by page as it is
+    consumed. It is None for single songs and in worker processes, where it can't be
+    sent back; iter_playlist then reopens the playlist.
+    """
+    info = _extract_unprocessed(search)
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        return _slim_info(_ytdl().process_ie_result(info, download=False)), None
+
+    entries = iter(info['entries'])
+    first = _take(entries, 1)
+    if not first:
+        raise _youtube_dl().utils.DownloadError(f'Nothing found for "{search}".')
+    if info.get('extractor_key', '').endswith('Search'):
+        return _slim_entry(first[0]), None
+
+    data = {'title': info.get('title'), 'webpage_url': info.get('webpage_url'),
+            'entries': [_slim_entry(first[0])], 'playlist': True}
+    return data, entries if _worker_ytdl is None else None
+
+
+def _open_playlist(url, skip):
+    """Return an iterator over the raw entries of a playlist, past the first skip."""
+    entries = iter(_extract_unprocessed(url)['entries'])
+    _take(entries, skip)
+    return entries
+
+
+def _extract_stream(url):
+    info = _ytdl().extract_info(url, download=False)
+    data = _slim_info(info)
+    data['url'] = info['url']
+    data['acodec'] = info.get('acodec')
+    if info.get('acodec') and info.get('abr'):
+        data['format'] = f"{info['acodec']} {info['abr']:.0f}k"
+    else:
+        data['format'] = info.get('format')
+    return data
+
+
+def _download_audio(url, directory):
+    """Download a song and store it as Opus in an Ogg file. Returns (path, size)."""
+    ytdl = _youtube_dl().YoutubeDL(dict(ytdlopts, outtmpl=os.path.join(
+        directory, 'tmp-%(id)s.%(ext)s'), noplaylist=True))
+    info = ytdl.extract_info(url, download=True)
+    source = info.get('_filename') or ytdl.prepare_filename(info)
+    target = os.path.join(directory, f"{info['extractor']}-{info['id']}.ogg")
+
+    # YouTube usually serves Opus already, then it only needs remuxing.
+    codec = ['-c:a', 'copy'] if info.get('acodec') == 'opus' else [
+        '-c:a', 'libopus', '-b:a', '96k']
+    try:
+        subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', source, '-vn', *codec, target],
+                       check=True, capture_output=True)
+    finally:
+        os.remove(source)
+    return target, os.path.getsize(target)
+
+
+def _download(search):
+    info = _ytdl().extract_info(search, download=True)
+    data = _slim_info(info)
+    data['filename'] = info.get('_filename') or _ytdl().prepare_filename(info)
+    return data
+
+
+class ResolveCache:
+    """Two-tier cache for resolved searches and URLs.
+    Results are kept in an in-memory LRU and in a SQLite table on disk, both bounded
+    by a TTL and a maximum number of entries. The disk tier survives restarts.
+    """
+
+    def __init__(self, path, *, size=256, disk_size=4096, ttl=6 * 3600):
+        self.path = path
+        self.size = size
+        self.disk_size = disk_size
+        self.ttl = ttl
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+
+    @staticmethod
+    def normalize(search: str):
+        """URLs are used verbatim, searches are case and whitespace insensitive."""
+        search = search.strip()
+        if search.startswith(('http://', 'https://')):
+            return search
+        return ' '.join(search.split()).casefold()
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                             'key TEXT PRIMARY KEY, data TEXT, stored REAL, used REAL)')
+        return self._db
+
+    def _disk_get(self, key):
+        with self._lock:
+            db = self._connect()
+            row = db.execute('SELECT data, stored FROM entries WHERE key = ?',
+                             (key,)).fetchone()
+            if row is None:
+                return None
+            data, stored = row
+            if time.time() - stored > self.ttl:
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                db.commit()
+                return None
+            db.execute('UPDATE entries SET used = ? WHERE key = ?',
+                       (time.time(), key))
+            db.commit()
+            return stored, json.loads(data)
+
+    def _disk_put(self, key, stored, data):
+        with self._lock:
+            db = self._connect()
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                       (key, json.dumps(data), stored, stored))
+            db.execute('DELETE FROM entries WHERE stored < ?',
+                       (time.time() - self.ttl,))
+            db.execute('DELETE FROM entries WHERE key NOT IN '
+                       '(SELECT key FROM entries ORDER BY used DESC LIMIT ?)', (self.disk_size,))
+            db.commit()
+
+    def _remember(self, key, stored, data):
+        self._memory[key] = (stored, data)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    async def get(self, key, *, loop):
+        """Return the cached info dict for key, or None."""
+        entry = self._memory.get(key)
+        if entry is not None:
+            stored, data = entry
+            if time.time() - stored <= self.ttl:
+                self._memory.move_to_end(key)
+                self.hits['memory'] += 1
+                return data
+            del self._memory[key]
+
+        try:
+            entry = await loop.run_in_executor(None, self._disk_get, key)
+        except sqlite3.Error:
+            traceback.print_exc(file=sys.stderr)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits['disk'] += 1
+        self._remember(key, *entry)
+        return entry[1]
+
+    async def put(self, key, data, *, loop):
+        stored = time.time()
+        self._remember(key, stored, data)
+        try:
+            await loop.run_in_executor(None, self._disk_put, key, stored, data)
+        except sqlite3.Error:
+            traceback.print_exc(file=sys.stderr)
+
+    def stats(self):
+        lookups = self.hits['memory'] + self.hits['disk'] + self.misses
+        ratio = (self.hits['memory'] + self.hits['disk']) / lookups if lookups else 0
+        return (f"memory hits: {self.hits['memory']} | disk hits: {self.hits['disk']} | "
+                f"misses: {self.misses} | hit rate: {ratio:.0%} | "
+                f"in memory: {len(self._memory)}/{self.size}")
+
+
+resolve_cache = ResolveCache(os.getenv('resolve_cache_path', 'cache/resolve.sqlite3'),
+                             size=int(os.getenv('resolve_cache_size', 256)),
+                             disk_size=int(
+                                 os.getenv('resolve_cache_disk_size', 4096)),
+                             ttl=int(os.getenv('resolve_cache_ttl', 6 * 3600)))
+
+
+class StreamCache:
+    """In-memory cache of resolved stream URLs, keyed by webpage URL.
+    Media URLs handed out by YouTube carry their own expiry (`expire=` in the query
+    or `/expire/<ts>/` in the path); when there is none a fixed TTL is assumed.
+    Entries are only served while they are further than `margin` seconds from expiring.
+    """
+
+    _path_expiry = re.compile(r'/expire/(\d+)')
+
+    def __init__(self, *, size=512, ttl=1800, margin=300):
+        self.size = size
+        self.ttl = ttl
+        self.margin = margin
+
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def expiry(self, url):
+        """Return the unix time at which the media URL stops working."""
+        try:
+            expire = parse_qs(urlparse(url).query).get('expire')
+            if expire:
+                return float(expire[0])
+            match = self._path_expiry.search(url)
+            if match:
+                return float(match.group(1))
+        except ValueError:
+            pass
+        return time.time() + self.ttl
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, data = entry
+            if expires - self.margin > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            del self._entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, data):
+        self._entries[key] = (self.expiry(data['url']), data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self):
+        return f"hits: {self.hits} | misses: {self.misses} | entries: {len(self._entries)}/{self.size}"
+
+
+stream_cache = StreamCache(size=int(os.getenv('stream_cache_size', 512)),
+                           ttl=int(os.getenv('stream_cache_ttl', 1800)),
+                           margin=int(os.getenv('stream_cache_margin', 300)))
+
+
+extract_seconds = metrics.histogram(
+    'bot_extract_seconds', 'Time an extraction job runs, after waiting for a worker.', SECONDS, 'job')
+first_audio_seconds = metrics.histogram(
+    'bot_first_audio_seconds', 'Time from !play on an idle player until its song starts.', SECONDS)
+track_gap_seconds = metrics.histogram(
+    'bot_track_gap_seconds', 'Silence between the end of a song and the start of the next.', SECONDS)
+
+
+# Extraction priority classes, most urgent first.
+PRIORITY_NEXT = 0  # The song that is about to play
+PRIORITY_INTERACTIVE = 1  # A user waiting on !play
+PRIORITY_BACKGROUND = 2  # Playlist expansion and other enrichment
+
+
+class ExtractionScheduler:
+    """Runs YTDL extractions on a dedicated, bounded thread pool.
+    Jobs are served by priority class, and within a class guilds take turns, so one guild
+    importing a huge playlist can't starve another guild's next song.
+    Jobs cancelled before they start are dropped without running.
+    With processes > 0, jobs submitted with process=True run in a pool of worker processes
+    instead, each with its own YoutubeDL, so CPU-heavy extraction doesn't contend on the GIL.
+    Up to workers jobs run at once, or one per process if there are more processes.
+    """
+
+    def __init__(self, workers=4, processes=0):
+        self.workers = max(workers, processes)
+        self.processes = processes
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='extract')
+        self._pool = self._new_pool() if processes else None
+        self.pool_restarts = 0
+        # One round robin of guild id -> pending jobs per priority class
+        self._classes = [OrderedDict() for _ in range(PRIORITY_BACKGROUND + 1)]
+        self._running = 0
+        self.promoted = 0
+
+        self.waits = [deque(maxlen=256) for _ in self._classes]
+
+    def run(self, func, *args, guild_id=None, priority=PRIORITY_INTERACTIVE, process=False):
+        """Schedule func(*args) and return a future for its result.
+        process=True allows running it in a worker process; func and its result must be picklable.
+        """
+        future = asyncio.get_event_loop().create_future()
+        jobs = self._classes[priority].setdefault(guild_id, deque())
+        jobs.append((future, process, func, args, time.perf_counter()))
+        self._pump()
+        return future
+
+    def promote(self, future, priority):
+        """Move the job of future, if it is still waiting in a less urgent class, to the front
+        of its guild's jobs in priority. Returns whether it was moved.
+        """
+        for lower in range(priority + 1, len(self._classes)):
+            guilds = self._classes[lower]
+            for guild_id, jobs in guilds.items():
+                for job in jobs:
+                    if job[0] is future:
+                        jobs.remove(job)
+                        if not jobs:
+                            del guilds[guild_id]
+                        self._classes[priority].setdefault(guild_id, deque()).appendleft(job)
+                        self.promoted += 1
+                        return True
+        return False
+
+    def warm_up(self):
+        """Start the worker processes ahead of the first extraction."""
+        if self._pool is not None:
+            try:
+                for _ in range(self.processes):
+                    self._pool.submit(os.getpid)
+            except BrokenProcessPool:
+                self._restart_pool()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def _restart_pool(self):
+        """Replace a pool broken by a worker process dying, e.g. killed for running out of memory."""
+        self._pool.shutdown(wait=False)
+        self._pool = self._new_pool()
+        self.pool_restarts += 1
+
+    def _next_job(self):
+        for priority, guilds in enumerate(self._classes):
+            if not guilds:
+                continue
+            guild_id, jobs = next(iter(guilds.items()))
+            job = jobs.popleft()
+            # The guild goes to the back of the line for its next job
+            del guilds[guild_id]
+            if jobs:
+                guilds[guild_id] = jobs
+            return priority, job
+        return None, None
+
+    def _pump(self):
+        while self._running < self.workers:
+            priority, job = self._next_job()
+            if job is None:
+                return
+            future, process, func, args, queued = job
+            if future.done():
+                continue
+
+            executor = self._pool if process and self._pool else self._executor
+            self.waits[priority].append(time.perf_counter() - queued)
+            try:
+                task = self._submit(executor, func, args)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            self._running += 1
+            task.add_done_callback(
+                partial(self._finished, future, func.__name__, time.perf_counter()))
+
+    def _submit(self, executor, func, args):
+        loop = asyncio.get_event_loop()
+        try:
+            return loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            if executor is not self._pool:
+                raise
+        # A worker process died since the last job, retry once on a fresh pool
+        self._restart_pool()
+        return loop.run_in_executor(self._pool, func, *args)
+
+    def _finished(self, future, name, started, task):
+        self._running -= 1
+        extract_seconds.observe(time.perf_counter() - started, name)
+        if not future.done():
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        self._pump()
+
+    def depth(self, priority=None):
+        classes = self._classes if priority is None else [
+            self._classes[priority]]
+        return sum(len(jobs) for guilds in classes for jobs in guilds.values())
+
+    def stats(self):
+        names = ('next', 'interactive', 'background')
+        parts = []
+        for priority, name in enumerate(names):
+            waits = self.waits[priority]
+            wait = f"{sum(waits) / len(waits) * 1000:.0f} ms" if waits else "n/a"
+            parts.append(
+                f"{name}: {self.depth(priority)} queued, avg wait {wait}")
+        backend = f"{self.processes} processes, restarted {self.pool_restarts}x" if self._pool else "threads"
+        return f"running: {self._running}/{self.workers} ({backend}) | promoted: {self.promoted}\n" + "\n".join(parts)
+
+
+# extract_backend=process moves extraction into extract_processes worker processes
+scheduler = ExtractionScheduler(workers=int(os.getenv('extract_workers', 4)),
+                                processes=int(os.getenv('extract_processes', os.cpu_count() or 1))
+                                if os.getenv('extract_backend') == 'process' else 0)
+
+
+class SingleFlight:
+    """Coalesces concurrent identical lookups into a single shared call.
+    The first caller for a key runs it and gets the result as is; callers arriving while
+    it is in flight wait for the same result and get share(result), a private copy.
+    The call is only cancelled once every caller waiting on it has been cancelled.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> [future, number of waiting callers]
+        self.coalesced = 0
+
+    async def do(self, key, make, *, share=copy.deepcopy):
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = self._calls[key] = [asyncio.ensure_future(make()), 0]
+            call[0].add_done_callback(partial(self._done, key, call))
+        else:
+            self.coalesced += 1
+
+        future = call[0]
+        call[1] += 1
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if call[1] == 1 and not future.done():
+                future.cancel()
+            raise
+        finally:
+            call[1] -= 1
+
+        return result if leader else share(result)
+
+    def in_flight(self, key):
+        """The future of the call running for key, or None."""
+        call = self._calls.get(key)
+        return call[0] if call is not None else None
+
+    def _done(self, key, call, future):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not future.cancelled():
+            future.exception()  # Mark it retrieved, every caller gets it raised
+
+    def stats(self):
+        return f"in flight: {len(self._calls)} | coalesced: {self.coalesced}"
+
+
+extractions = SingleFlight()
+
+
+def _guild_id(song):
+    """Return the id of the guild a queued song was requested in."""
+    guild = getattr(song.requester, 'guild', None)
+    return guild.id if guild is not None else None
+
+
+def format_duration(seconds):
+    """Format a duration in seconds like 1h 02m 03s, or 02m 03s when under an hour."""
+    if seconds is None:
+        return "--m --s"
+    hour = seconds // 3600
+    seconds %= 3600
+    minutes = seconds // 60
+    seconds %= 60
+    if hour > 0:
+        return "%dh %02dm %02ds" % (hour, minutes, seconds)
+    return "%02dm %02ds" % (minutes, seconds)
+
+
+class Track:
+    """A queued song, not resolved to a stream yet.
+    thumbnail and format are filled in by the background enricher, and the title too
+    where the playlist didn't have it.
+    """
+
+    __slots__ = ('webpage_url', 'title', 'requester', 'duration',
+                 'thumbnail', 'format', 'enriched', 'queued')
+
+    def __init__(self, webpage_url, title, requester, duration=None):
+        self.webpage_url = webpage_url
+        self.title = title or webpage_url  # Playlists cached before entries got a fallback title
+        self.requester = requester
+        self.duration = duration
+
+        self.thumbnail = None
+        self.format = None
+        self.enriched = False
+        self.queued = False  # Maintained by TrackQueue
+
+    def __getitem__(self, item: str):
+        """Allows us to access attributes similar to a dict, like YTDLSource."""
+        return getattr(self, item)
+
+
+class TrackQueue:
+    """The queue of upcoming songs of a guild.
+    Backed by a deque, so appending and taking the next song are O(1), and positional
+    removal and moves only walk to the nearer end of the queue.
+    get() waits for the next song like asyncio.Queue.get(). version changes on every
+    modification, so views of the queue can be cached. The total duration is kept up
+    to date as songs come and go, songs of unknown length are counted separately.
+    """
+
+    def __init__(self):
+        self._tracks = deque()
+        self._ready = asyncio.Event()
+        self.version = 0
+        self.duration = 0
+        self.unknown = 0
+
+    def _count(self, track, sign=1):
+        track.queued = sign > 0
+        if track.duration is None:
+            self.unknown += sign
+        else:
+            self.duration += sign * track.duration
+
+    def _recount(self, dropped=()):
+        for track in dropped:
+            track.queued = False
+        self.duration = self.unknown = 0
+        for track in self._tracks:
+            self._count(track)
+
+    def set_duration(self, track, duration):
+        """Update the length of a song, keeping the queue total right if it is still queued."""
+        if track.queued:
+            self._count(track, -1)
+            track.duration = duration
+            self._count(track)
+            self.version += 1
+        else:
+            track.duration = duration
+
+    def set_title(self, track, title):
+        track.title = title
+        if track.queued:
+            self.version += 1
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __iter__(self):
+        return iter(self._tracks)
+
+    def __getitem__(self, index):
+        return self._tracks[index]
+
+    def empty(self):
+        return not self._tracks
+
+    @property
+    def head(self):
+        return self._tracks[0] if self._tracks else None
+
+    def _changed(self):
+        self.version += 1
+        if self._tracks:
+            self._ready.set()
+
+    def put(self, track):
+        self._tracks.append(track)
+        self._count(track)
+        self._changed()
+
+    def extend(self, tracks):
+        for track in tracks:
+            self._tracks.append(track)
+            self._count(track)
+        self._changed()
+
+    async def get(self):
+        """Remove and return the next song, waiting for one if the queue is empty."""
+        while not self._tracks:
+            self._ready.clear()
+            await self._ready.wait()
+        track = self._tracks.popleft()
+        self._count(track, -1)
+        self._changed()
+        return track
+
+    def pop(self, index=-1):
+        """Remove and return the song at index (0-based)."""
+        track = self._tracks[index]
+        del self._tracks[index]
+        self._count(track, -1)
+        self._changed()
+        return track
+
+    def move(self, index, to=0):
+        """Move the song at index to position to (both 0-based)."""
+        track = self._tracks[index]
+        del self._tracks[index]
+        self._tracks.insert(to, track)
+        self._changed()
+        return track
+
+    def shuffle(self):
+        tracks = list(self._tracks)
+        random.shuffle(tracks)
+        self._tracks = deque(tracks)
+        self._changed()
+
+    def dedupe(self):
+        """Drop every song that is already queued earlier on. Returns how many were removed."""
+        seen = set()
+        tracks = deque()
+        dropped = []
+        for track in self._tracks:
+            if track.webpage_url not in seen:
+                seen.add(track.webpage_url)
+                tracks.append(track)
+            else:
+                dropped.append(track)
+        self._tracks = tracks
+        self._recount(dropped)
+        self._changed()
+        return len(dropped)
+
+    def clear(self):
+        dropped = list(self._tracks)
+        self._tracks.clear()
+        self._recount(dropped)
+        self._changed()
+
+
+class AudioCache:
+    """Size-bounded cache of frequently played songs, stored locally as Opus.
+    A song is downloaded in the background once it has been played min_plays times,
+    and the least recently used files are evicted to stay under max_bytes.
+    The index is kept in a JSON file in the cache directory.
+    """
+
+    def __init__(self, directory, *, max_bytes=512 * 2**20, min_plays=2, max_index=4096):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_index = max_index
+
+        self._index_path = os.path.join(directory, 'index.json')
+        self._index = None  # webpage url -> {'file', 'size', 'plays', 'used'}
+        self._storing = set()
+        self._save_handle = None
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @property
+    def index(self):
+        if self._index is None:
+            try:
+                with open(self._index_path) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save(self):
+        self._save_handle = None
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self._index_path)
+
+    def _save_soon(self):
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_event_loop().call_later(30, self._save)
+
+    def size(self):
+        return sum(entry['size'] for entry in self.index.values() if entry.get('file'))
+
+    def path(self, url):
+        """Return the cached file for url, or None. Doesn't count as a lookup."""
+        entry = self.index.get(url)
+        if entry and entry.get('file') and os.path.exists(entry['file']):
+            return entry['file']
+        return None
+
+    def lookup(self, url):
+        path = self.path(url)
+        if path is None:
+            self.misses += 1
+            return None
+        entry = self.index[url]
+        entry['used'] = time.time()
+        self.hits += 1
+        self.bytes_saved += entry['size']
+        self._save_soon()
+        return path
+
+    def played(self, url, guild_id=None):
+        """Count a play of url, and start caching it once it is popular enough."""
+        if not self.max_bytes:
+            return  # Nothing would ever be cached
+        entry = self.index.setdefault(url, {'file': None, 'size': 0, 'plays': 0})
+        entry['plays'] += 1
+        entry['used'] = time.time()
+        if not entry['file'] and entry['plays'] >= self.min_plays and url not in self._storing:
+            self._storing.add(url)
+            asyncio.get_event_loop().create_task(self._store(url, guild_id))
+        if len(self.index) > self.max_index:
+            self._prune()
+        self._save_soon()
+
+    async def _store(self, url, guild_id):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path, size = await scheduler.run(_download_audio, url, self.directory, guild_id=guild_id,
+                                             priority=PRIORITY_BACKGROUND, process=True)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            return
+        finally:
+            self._storing.discard(url)
+
+        entry = self.index.setdefault(url, {'plays': 0})
+        entry.update(file=path, size=size, used=time.time())
+        self._evict()
+        self._save()
+
+    def _evict(self):
+        by_use = sorted(self.index.items(), key=lambda item: item[1].get('used', 0))
+        total = self.size()
+        for url, entry in by_use:
+            if total <= self.max_bytes:
+                break
+            if entry.get('file'):
+                try:
+                    os.remove(entry['file'])
+                except OSError:
+                    pass
+                total -= entry['size']
+                entry.update(file=None, size=0)
+        self._prune()
+
+    def _prune(self):
+        """Forget play counts of the least recently used songs that aren't cached, down to 90%
+        of max_index, so it isn't sorted again on every play while downloads fail.
+        """
+        extra = len(self.index) - self.max_index
+        if extra <= 0:
+            return
+        extra += self.max_index // 10
+        by_use = sorted(self.index.items(), key=lambda item: item[1].get('used', 0))
+        for url, entry in by_use:
+            if extra <= 0:
+                break
+            if not entry.get('file'):
+                del self.index[url]
+                extra -= 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0
+        files = sum(1 for entry in self.index.values() if entry.get('file'))
+        return (f"hits: {self.hits} | misses: {self.misses} | hit rate: {ratio:.0%} | "
+                f"saved: {self.bytes_saved / 2**20:.1f} MiB | "
+                f"{files} files, {self.size() / 2**20:.1f}/{self.max_bytes / 2**20:.0f} MiB")
+
+
+audio_cache = AudioCache(os.getenv('audio_cache_dir', 'downloads'),
+                         max_bytes=int(
+                             os.getenv('audio_cache_size_mb', 512)) * 2**20,
+                         min_plays=int(os.getenv('audio_cache_min_plays', 2)))
+
+
+class VoiceConnectionError(commands.CommandError):
+    """Custom Exception class for connection errors."""
+
+
+class InvalidVoiceChannel(VoiceConnectionError):
+    """Exception for cases of invalid Voice Channels."""
+
+
+class FFmpegLimitError(commands.CommandError):
+    """Exception for when no more ffmpeg processes may be started."""
+
+
+class FFmpegSupervisor:
+    """Keeps track of every ffmpeg process started for playback.
+    At most max_processes may run at once. Guilds starting their first one may only use
+    max_processes - reserve of them, the rest is kept for songs already playing to
+    pre-spawn the next song or restart at a new position.
+    A periodic sweep kills orphans: processes whose source was garbage collected without
+    cleanup, or that no player is using anymore (as told by live_sources).
+    """
+
+    def __init__(self, max_processes=64, *, reserve=None, interval=30, grace=15):
+        self.max_processes = max_processes
+        self.reserve = max_processes // 8 if reserve is None else reserve
+        self.interval = interval
+        self.grace = grace  # Seconds a new process may go without being played
+        self.live_sources = lambda: ()
+
+        self._records = {}  # pid -> record dict
+        self._lock = threading.Lock()  # Sources are cleaned up on the voice threads
+        self._reaper = None
+        self.started = 0
+        self.reaped = 0
+
+    @staticmethod
+    def _process(source):
+        # PCM sources wrap the FFmpegPCMAudio that owns the process
+        return getattr(source, '_process', None) or getattr(getattr(source, 'original', None), '_process', None)
+
+    def _snapshot(self):
+        with self._lock:
+            return list(self._records.items())
+
+    def _running(self):
+        return [r for _, r in self._snapshot() if r['process'].poll() is None]
+
+    def admit(self, guild_id):
+        """Raise FFmpegLimitError if the guild may not start another process right now."""
+        if not self.max_processes:
+            return
+        running = self._running()
+        limit = self.max_processes
+        if not any(r['guild_id'] == guild_id for r in running):
+            limit -= self.reserve
+        if len(running) < limit:
+            return
+        self.sweep()
+        if len(self._running()) >= limit:
+            raise FFmpegLimitError(
+                'Too many songs are playing right now, try again in a bit.')
+
+    def register(self, source, guild_id):
+        process = self._process(source)
+        if process is None:
+            return
+        self.started += 1
+        with self._lock:
+            self._records[process.pid] = {'process': process, 'guild_id': guild_id, 'source': weakref.ref(source),
+                                          'title': source.title, 'started': time.time()}
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.get_event_loop().create_task(self._reap_loop())
+
+    def release(self, source):
+        process = self._process(source)
+        if process is not None:
+            with self._lock:
+                self._records.pop(process.pid, None)
+
+    def sweep(self):
+        """Forget exited processes and kill orphans."""
+        live = {id(source) for source in self.live_sources()}
+        now = time.time()
+        for pid, record in self._snapshot():
+            process = record['process']
+            if process.poll() is not None:
+                self._forget(pid, record)
+                continue
+            source = record['source']()
+            if source is None or (now - record['started'] > self.grace and id(source) not in live):
+                process.kill()
+                process.wait()
+                self._forget(pid, record)
+                self.reaped += 1
+
+    def _forget(self, pid, record):
+        with self._lock:
+            # Unless the pid was reused by a process registered since
+            if self._records.get(pid) is record:
+                del self._records[pid]
+
+    async def _reap_loop(self):
+        while self._records:
+            await asyncio.sleep(self.interval)
+            self.sweep()
+
+    @staticmethod
+    def usage(pid):
+        """Return (cpu seconds, rss bytes) of a process from /proc, or None where unavailable."""
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+            with open(f'/proc/{pid}/statm') as f:
+                rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            return cpu, rss
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def report(self):
+        """One line per running process: pid, guild, lifetime, CPU and memory."""
+        lines = []
+        for pid, record in self._snapshot():
+            age = time.time() - record['started']
+            usage = self.usage(pid)
+            if usage is None:
+                resources = "cpu/rss n/a"
+            else:
+                cpu, rss = usage
+                resources = f"cpu {cpu:.1f}s ({cpu / max(age, 1):.0%}) | rss {rss / 2**20:.1f} MiB"
+            lines.append(f"`{pid}` guild {record['guild_id']} | {format_duration(age)} | {resources} | "
+                         f"{(record['title'] or '')[:40]}")
+        return lines
+
+    def stats(self):
+        running = len(self._running())
+        limit = self.max_processes or "∞"
+        return f"running: {running}/{limit} ({self.reserve} reserved) | started: {self.started} | orphans reaped: {self.reaped}"
+
+
+_ffmpeg_max = int(os.getenv('ffmpeg_max', 64))
+# ffmpeg_reserve of them are kept for songs already playing, an eighth by default
+supervisor = FFmpegSupervisor(_ffmpeg_max, reserve=int(os.getenv('ffmpeg_reserve', _ffmpeg_max // 8)))
+
+
+# opus: ffmpeg encodes Opus itself and applies the volume as a filter (OpusSource).
+# pcm: ffmpeg decodes to PCM, the volume is scaled and Opus encoded in Python (YTDLSource).
+AUDIO_MODE = os.getenv('audio_mode', 'opus')
+
+
+def _worker_pool(count, capacity):
+    """Audio workers decoding for the configured audio mode."""
+    return AudioWorkerPool(count, capacity, pcm_decoder if AUDIO_MODE == 'pcm' else ffmpeg_decoder)
+
+
+# audio_workers > 0 moves ffmpeg, and in pcm mode the volume and Opus encoding, into that many
+# worker processes, see audio_worker.py.
+# Each runs up to audio_worker_capacity streams, these don't count against ffmpeg_max.
+audio_workers = _worker_pool(int(os.getenv('audio_workers', 0)),
+                             int(os.getenv('audio_worker_capacity', 32)))
+# Seconds without a packet from a worker after which a song counts as dropped
+WORKER_STALL = float(os.getenv('audio_worker_stall', 5))
+
+
+# Seconds before a song ends to start the next song's ffmpeg, 0 disables it.
+GAPLESS_LEAD = float(os.getenv('gapless_lead', 3))
+# Seconds of fade out/fade in between songs, 0 disables it.
+CROSSFADE = float(os.getenv('crossfade', 0))
+
+
+def _before_options(start=0, media=''):
+    before = ffmpegopts['before_options']
+    if media.startswith(('http://', 'https://')):
+        # Let ffmpeg ride out short network hiccups on its own
+        before += ' -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+    if start:
+        before += f' -ss {start:.2f}'
+    return before
+
+
+def _fades(data, start=0):
+    """Return the ffmpeg audio filters fading a song in and out, if crossfade is enabled."""
+    if not CROSSFADE:
+        return []
+    filters = []
+    if not start:
+        filters.append(f'afade=t=in:d={CROSSFADE}')
+    duration = data.get('duration')
+    if duration and duration - start > 2 * CROSSFADE:
+        # Output timestamps start at 0 when seeking with -ss
+        filters.append(
+            f'afade=t=out:st={duration - start - CROSSFADE:.2f}:d={CROSSFADE}')
+    return filters
+
+
+def _pcm_options(data, start=0):
+    """Return the options of an ffmpeg outputting PCM, see YTDLSource."""
+    options = ffmpegopts['options']
+    filters = _fades(data, start)
+    if filters:
+        options += f" -filter:a {','.join(filters)}"
+    return options
+
+
+def _opus_args(media, data, volume=1.0, start=0):
+    """Return codec, before_options and options of an ffmpeg outputting Opus, see OpusSource."""
+    options = ffmpegopts['options']
+    filters = _fades(data, start)
+    if volume != 1:
+        filters.append(f'volume={volume:.2f}')
+    if filters:
+        options += f" -filter:a {','.join(filters)}"
+    # codec='opus' makes discord.py copy the stream instead of encoding it
+    codec = 'opus' if not filters and data.get('acodec') == 'opus' else None
+    return codec, _before_options(start, media), options
+
+
+class SongSource:
+    """Song details and playback position shared by the audio sources."""
+
+    def cleanup(self):
+        # Before FFmpegAudio.cleanup, which drops the process the record is found by
+        supervisor.release(self)
+        super().cleanup()
+
+    def _init_song(self, data, requester, media=None, start=0):
+        self.requester = requester
+        self.data = data
+        self.media = media  # The URL or file ffmpeg reads, to restart it elsewhere in the song
+        self.start = start
+        self.frames = 0
+
+        self.title = data.get('title')
+        self.web_url = data.get('webpage_url')
+        self.duration = data.get('duration')
+        self.thumbnail = data.get('thumbnail')
+
+        # YTDL info dicts (data) have other useful information you might want
+        # https://github.com/rg3/youtube-dl/blob/master/README.md
+
+    @property
+    def position(self):
+        """Seconds into the song, counted from the 20 ms frames actually read."""
+        return self.start + self.frames * 0.02
+
+    def __getitem__(self, item: str):
+        """Allows us to access attributes similar to a dict.
+        This is only useful when you are NOT downloading.
+        """
+        return self.__getattribute__(item)
+
+
+class YTDLSource(SongSource, discord.PCMVolumeTransformer):
+
+    def __init__(self, source, *, data, requester, media=None, start=0):
+        super().__init__(source)
+        self._init_song(data, requester, media, start)
+
+    def read(self):
+        frame = super().read()
+        if frame:
+            self.frames += 1
+        return frame
+
+    @classmethod
+    def from_media(cls, media, *, data, requester, volume=1.0, start=0):
+        """Build a playable source for a stream URL or local file in the configured audio mode.
+        The ffmpeg process is registered with the supervisor, which may refuse to start it.
+        """
+        guild_id = getattr(getattr(requester, 'guild', None), 'id', None)
+        if audio_workers.count:
+            if AUDIO_MODE == 'pcm':
+                args = (media, volume, _before_options(start, media), _pcm_options(data, start))
+            else:
+                args = (media, *_opus_args(media, data, volume, start))
+            stream = audio_workers.open(guild_id, args)
+            if stream is None:
+                raise FFmpegLimitError(
+                    'Too many songs are playing right now, try again in a bit.')
+            return RemoteAudioSource(stream, data=data, requester=requester, media=media, volume=volume, start=start)
+
+        supervisor.admit(guild_id)
+
+        if AUDIO_MODE == 'opus':
+            source = OpusSource(media, data=data, requester=requester, volume=volume, start=start)
+            supervisor.register(source, guild_id)
+            return source
+
+        source = cls(discord.FFmpegPCMAudio(media, before_options=_before_options(start, media),
+                                            options=_pcm_options(data, start)),
+                     data=data, requester=requester, media=media, start=start)
+        source.volume = volume
+        supervisor.register(source, guild_id)
+        return source
+
+    @classmethod
+    async def create_source(cls, ctx, search: str, *, loop, download=False):
+        loop = loop or asyncio.get_event_loop()
+
+        # Downloads need the full info dict, so only streamed lookups are cached.
+        key = resolve_cache.normalize(search)
+        data = None if download else await resolve_cache.get(key, loop=loop)
+
+        if data is None and download:
+            data = await extractions.do(('download', key), partial(
+                scheduler.run, _download, search, guild_id=ctx.guild.id, process=True))
+        elif data is None:
+            # Concurrent callers share the extraction, but only the first one can consume
+            # the live playlist iterator; the others reopen the playlist.
+            data, entries = await extractions.do(('head', key), partial(
+                scheduler.run, _extract_head, search, guild_id=ctx.guild.id, process=True),
+                share=lambda result: (copy.deepcopy(result[0]), None))
+            if 'playlist' in data:
+                # Only the first entry is known here, iter_playlist streams in the rest.
+                data = dict(data, pending=entries, cache_key=key)
+            else:
+                await resolve_cache.put(key, data, loop=loop)
+
+        if 'entries' in data:
+            # take first item from a playlist
+            # data = data['entries'][0]
+            embed = discord.Embed(
+                title="", description=f"Queued playlist [{data['title']}]({data['webpage_url']}) [{ctx.author.mention}]", color=discord.Color.green())
+            await ctx.send(embed=embed)
+        else:
+            embed = discord.Embed(
+                title="", description=f"Queued [{data['title']}]({data['webpage_url']}) [{ctx.author.mention}]", color=discord.Color.green())
+            await ctx.send(embed=embed)
+
+        if download:
+            source = data['filename']
+        else:
+            if 'entries' in data:
+                return data
+            else:
+                return Track(data['webpage_url'], data['title'], ctx.author, data.get('duration'))
+
+        return cls.from_media(source, data=data, requester=ctx.author)
+
+    @classmethod
+    async def iter_playlist(cls, data, *, loop, guild_id=None, chunk=50):
+        """Yield the entries of a playlist returned by create_source, in chunks as they are extracted.
+        Once a lazily extracted playlist is complete it is added to the resolve cache.
+        """
+        entries = list(data['entries'])
+        yield entries
+
+        if 'playlist' not in data:
+            return
+
+        pending = data.get('pending')
+        if pending is None:
+            pending = await scheduler.run(_open_playlist, data['webpage_url'], len(entries),
+                                          guild_id=guild_id, priority=PRIORITY_BACKGROUND)
+
+        while True:
+            raw = await scheduler.run(_take, pending, chunk, guild_id=guild_id,
+                                      priority=PRIORITY_BACKGROUND)
+            if not raw:
+                break
+            songs = [_slim_entry(entry) for entry in raw]
+            entries.extend(songs)
+            yield songs
+
+        await resolve_cache.put(data['cache_key'], {'title': data['title'], 'webpage_url': data['webpage_url'],
+                                                   'entries': entries}, loop=loop)
+
+    @classmethod
+    async def resolve_stream(cls, data, *, loop, priority=PRIORITY_NEXT):
+        """Resolve the stream info of a queued song, reusing a cached URL when it is still fresh."""
+        webpage_url = data.webpage_url
+
+        info = stream_cache.get(webpage_url)
+        if info is None:
+            key = ('stream', webpage_url)
+            running = extractions.in_flight(key)
+            if running is not None:
+                # Joining a lookup queued less urgently, e.g. by the enricher, mustn't wait behind it
+                scheduler.promote(running, priority)
+            info = await extractions.do(key, partial(
+                scheduler.run, _extract_stream, webpage_url, guild_id=_guild_id(data),
+                priority=priority, process=True))
+            stream_cache.put(webpage_url, info)
+
+        return info
+
+    @classmethod
+    async def regather_stream(cls, data, *, loop, info=None, volume=1.0):
+        """Used for preparing a stream, instead of downloading.
+        Since Youtube Streaming links expire."""
+        requester = data.requester
+        if info is None:
+            info = await cls.resolve_stream(data, loop=loop)
+
+        return cls.from_media(info['url'], data=info, requester=requester, volume=volume)
+
+
+class OpusSource(SongSource, discord.FFmpegOpusAudio):
+    """Opus-native counterpart of YTDLSource, used in the default opus audio mode.
+    ffmpeg outputs Opus packets that the voice client sends as they are. In pcm mode
+    every 20 ms frame is decoded to PCM, volume scaled in Python by PCMVolumeTransformer
+    and Opus encoded again by the voice client, which is the bulk of a stream's CPU
+    cost in this process. Here that work moves into ffmpeg, and at 100% volume Opus
+    input (most of YouTube, and the audio cache) is only remuxed. Players start at 50%
+    volume though, so by default ffmpeg still decodes, filters and encodes every song;
+    the remux only applies after !volume 100.
+    The volume is an ffmpeg filter, so changing it restarts ffmpeg at the current
+    position, see MusicPlayer.restart.
+    Compare the CPU per stream of both modes with bench.py --ffmpeg-streams.
+    """
+
+    def __init__(self, media, *, data, requester, volume=1.0, start=0):
+        codec, before_options, options = _opus_args(
+            media, data, volume, start)
+        super().__init__(media, codec=codec,
+                         before_options=before_options, options=options)
+        self._init_song(data, requester, media, start)
+        self.volume = volume
+
+    def read(self):
+        packet = super().read()
+        if packet:
+            self.frames += 1
+        return packet
+
+
+class RemoteAudioSource(SongSource, discord.AudioSource):
+    """Plays the Opus packets an audio worker process produces for a song, with audio_workers.
+    The volume is applied in the worker, an ffmpeg filter in opus mode or scaled before
+    encoding in pcm mode. Either way changing it restarts the stream.
+    """
+
+    def __init__(self, stream, *, data, requester, media, volume=1.0, start=0):
+        self._stream = stream
+        self._init_song(data, requester, media, start)
+        self.volume = volume
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        packet = self._stream.read(WORKER_STALL)
+        if packet:
+            self.frames += 1
+        return packet
+
+    def cleanup(self):
+        self._stream.close()
+        super().cleanup()
+
+
+# Seconds between updates of a live now playing message, 0 sends a plain message per song instead.
+LIVE_NP = float(os.getenv('live_np', 0))
+PROGRESS_BAR = "──────────────────────────────"
+
+
+def np_template(source, bot):
+    """The parts of the now playing embed that don't change while the song plays."""
+    embed = discord.Embed(
+        title="", description=f"[{source.title}]({source.web_url}) [{source.requester.mention}] | `{datetime.timedelta(seconds=round(source.duration or 0))}`", color=discord.Color.green())
+    embed.set_author(icon_url=bot.user.avatar_url,
+                     name=f"Now Playing 🎶")
+    if source.thumbnail:
+        embed.set_thumbnail(url=source.thumbnail)
+    return embed
+
+
+def np_progress(template, source):
+    """A copy of template with the progress of source filled in."""
+    seconds = (source.duration or 0) % (24 * 3600)
+
+    time_played = source.position
+    progress_perc = min(round(time_played / seconds * 30), 29) if seconds else 0
+
+    duration = datetime.timedelta(seconds=round(seconds))
+
+    progress_bar = PROGRESS_BAR[:progress_perc] + \
+        "⚪" + PROGRESS_BAR[progress_perc+1:]
+
+    time_now = datetime.timedelta(seconds=round(time_played))
+
+    embed = copy_embed(template)
+    embed.add_field(
+        # ⚪
+        name="Progress", value=f"{progress_bar}", inline=False)
+    embed.add_field(
+        name="** **", value=f"──── ◄◄⠀▐▐ ⠀►►⠀⠀ ⠀ {time_now} / {duration} ⠀ ───○ 🔊", inline=False)
+    return embed
+
+
+ENRICH_BATCH = int(os.getenv('enrich_batch', 4))
+MAX_RESUMES = int(os.getenv('max_resumes', 3))  # Reconnects per song
+# Seconds to wait for a listener to come back before leaving an empty voice channel
+EMPTY_CHANNEL_GRACE = float(os.getenv('empty_channel_grace', 120))
+EMPTY_CHANNEL_RELEASE = os.getenv('empty_channel_release', '1') == '1'
+
+
+# Seconds without songs after which a player hibernates, and after which it disconnects.
+HIBERNATE_AFTER = float(os.getenv('hibernate_after', 60))
+IDLE_TIMEOUT = float(os.getenv('idle_timeout', 300))
+
+
+class PlayerState:
+    """What is kept of a hibernated MusicPlayer: no task, no event and no queue."""
+
+    __slots__ = ('volume', 'timer')
+
+    def __init__(self, volume, timer):
+        self.volume = volume
+        self.timer = timer  # Disconnects the guild when it fires
+
+
+class MusicPlayer:
+    """A class which is assigned to each guild using the bot for Music.
+    This class implements a queue and loop, which allows for different guilds to listen to different playlists
+    simultaneously.
+    When the bot disconnects from the Voice it's instance will be destroyed.
+    When it runs out of songs it hibernates into a PlayerState until the next !play.
+    """
+
+    __slots__ = ('bot', '_guild', '_channel', '_cog', 'queue', 'next', 'current',
+                 'np', 'volume', '_prefetch', '_ended_at', 'last_gap', 'pages',
+                 '_to_enrich', '_enricher', '_spawned', '_spawner', '_stopped', '_resumes',
+                 'suspended', '_suspend_timer', '_suspend_position', '_np_live',
+                 'requested', '_task')
+
+    def __init__(self, ctx, state=None):
+        self.bot = ctx.bot
+        self._guild = ctx.guild
+        self._channel = ctx.channel
+        self._cog = ctx.cog
+
+        self.queue = TrackQueue()
+        self.next = asyncio.Event()
+
+        self.np = None  # Now playing message
+        self._np_live = None  # Task keeping it up to date, with live_np
+        self.volume = state.volume if state is not None else .5
+        self.current = None
+        self._stopped = False  # The current song was ended on purpose
+        self._resumes = 0
+
+        self._prefetch = None  # (queued song, task resolving its stream)
+        self._ended_at = None
+        self.last_gap = None  # Seconds of silence between the last two songs
+        self.pages = (None, {})  # Rendered !queue pages, valid for one queue version
+
+        self._to_enrich = deque()
+        self._enricher = None
+
+        self._spawned = None  # (queued song, its already started source)
+        self._spawner = None
+
+        self.suspended = False  # Nobody is listening: 'idle' or 'paused' by suspend()
+        self._suspend_timer = None
+        self._suspend_position = None  # Where to restart a released song
+        self.requested = None  # When !play was used while the player was idle
+
+        self._task = ctx.bot.loop.create_task(self.player_loop())
+
+    def refresh_prefetch(self):
+        """Start resolving the song at the head of the queue while the current one plays.
+        Must be called whenever the queue changes; a stale lookahead is cancelled.
+        """
+        head = self.queue.head
+        if self._spawned is not None and self._spawned[0] is not head:
+            self.drop_spawned()
+            if self._spawner is not None and self._spawner.done():
+                # Spawn the new head instead
+                self._spawner = self.bot.loop.create_task(self._spawn_next())
+        if self._prefetch is not None and self._prefetch[0] is head:
+            return
+
+        self.cancel_prefetch()
+        if head is None or self.current is None or audio_cache.path(head.webpage_url):
+            return
+
+        task = self.bot.loop.create_task(
+            YTDLSource.resolve_stream(head, loop=self.bot.loop))
+        # The result is only consumed if the song is still at the head when it is needed.
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._prefetch = (head, task)
+
+    def enrich(self, tracks):
+        """Fill in duration, thumbnail and stream format of queued songs in the background."""
+        self._to_enrich.extend(tracks)
+        if self._enricher is None or self._enricher.done():
+            self._enricher = self.bot.loop.create_task(self._enrich_loop())
+
+    def cancel_enrich(self):
+        self._to_enrich.clear()
+        if self._enricher is not None:
+            self._enricher.cancel()
+            self._enricher = None
+
+    async def _enrich_loop(self):
+        while self._to_enrich:
+            batch = []
+            while self._to_enrich and len(batch) < ENRICH_BATCH:
+                track = self._to_enrich.popleft()
+                if track.queued and not track.enriched:
+                    batch.append(track)
+
+            results = await asyncio.gather(*(YTDLSource.resolve_stream(track, loop=self.bot.loop,
+                                                                       priority=PRIORITY_BACKGROUND)
+                                             for track in batch), return_exceptions=True)
+            for track, info in zip(batch, results):
+                track.enriched = True
+                if isinstance(info, Exception):
+                    continue
+                track.thumbnail = info.get('thumbnail')
+                track.format = info.get('format')
+                if info.get('title') and info['title'] != track.title:
+                    self.queue.set_title(track, info['title'])
+                if info.get('duration') is not None and info['duration'] != track.duration:
+                    self.queue.set_duration(track, info['duration'])
+
+    async def _spawn_next(self):
+        """Start the next song's ffmpeg shortly before the current song ends, so it is buffered
+        by the time it is handed over.
+        """
+        while True:
+            # Re-read the current source, it is replaced when restarted
+            source = self.current
+            if not GAPLESS_LEAD or source is None or not source.duration:
+                return
+            remaining = source.duration - source.position
+            if remaining <= GAPLESS_LEAD:
+                break
+            # Position only advances while playing, so check again rather than sleep it all
+            await asyncio.sleep(min(remaining - GAPLESS_LEAD, 5))
+
+        head = self.queue.head
+        if head is None or self._spawned is not None:
+            return
+        try:
+            spawned = await self._prepare(head)
+        except Exception:
+            return  # player_loop tries again, and reports the error
+        if self.queue.head is head and self._spawned is None:
+            self._spawned = (head, spawned)
+        else:
+            spawned.cleanup()
+
+    def drop_spawned(self, stop=False):
+        """Tear down a started but not yet playing ffmpeg process.
+        With stop=True no other one is started for the current song.
+        """
+        if stop and self._spawner is not None:
+            self._spawner.cancel()
+            self._spawner = None
+        if self._spawned is not None:
+            self._spawned[1].cleanup()
+            self._spawned = None
+
+    def cancel_prefetch(self):
+        if self._prefetch is not None:
+            self._prefetch[1].cancel()
+            self._prefetch = None
+
+    async def _prepare(self, song):
+        """Turn a queued song into a playable source.
+        Songs in the audio cache are played from disk, otherwise the lookahead result is used if it matches.
+        """
+        path = audio_cache.lookup(song.webpage_url)
+        if path is not None:
+            self.cancel_prefetch()
+            data = {'title': song.title, 'webpage_url': song.webpage_url,
+                    'duration': song.duration, 'thumbnail': song.thumbnail, 'acodec': 'opus'}
+            return YTDLSource.from_media(path, data=data, requester=song.requester, volume=self.volume)
+
+        info = None
+        if self._prefetch is not None and self._prefetch[0] is song:
+            task = self._prefetch[1]
+            self._prefetch = None
+            # asyncio.wait keeps a cancelled or failed lookahead apart from this task being cancelled
+            try:
+                await asyncio.wait({task})
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            if not task.cancelled() and task.exception() is None:
+                info = task.result()
+            # Otherwise it is resolved again below
+        else:
+            self.cancel_prefetch()
+
+        return await YTDLSource.regather_stream(song, loop=self.bot.loop, info=info, volume=self.volume)
+
+    def _song_ended(self):
+        # Only count the gap if something was already waiting to be played.
+        self._ended_at = None if self.queue.empty() else time.perf_counter()
+        self.next.set()
+
+    # ANCHOR player_loop
+    async def player_loop(self):
+        """Our main player loop."""
+        await self.bot.wait_until_ready()
+
+        while not self.bot.is_closed():
+            self.next.clear()
+
+            try:
+                # Wait for the next song. If we timeout hibernate the player, it disconnects later...
+                async with timeout(HIBERNATE_AFTER):
+                    source = await self.queue.get()
+            except asyncio.TimeoutError:
+                return self._cog.hibernate(self._guild, self)
+
+            if self._spawned is not None and self._spawned[0] is source:
+                # Its ffmpeg is already running and buffered
+                source = self._spawned[1]
+                self._spawned = None
+            elif isinstance(source, Track):
+                self.drop_spawned(stop=True)
+                # Source was probably a stream (not downloaded)
+                # So we should regather to prevent stream expiration
+                try:
+                    source = await self._prepare(source)
+                except Exception as e:
+                    await self._channel.send(f'There was an error processing your song.\n'
+                                             f'```css\n[{e}]\n```')
+                    continue
+
+            self.current = source
+            self._stopped = False
+            self._resumes = 0
+
+            self._guild.voice_client.play(
+                source, after=lambda _: self.bot.loop.call_soon_threadsafe(self._song_ended))
+            if self._ended_at is not None:
+                self.last_gap = time.perf_counter() - self._ended_at
+                self._ended_at = None
+                track_gap_seconds.observe(self.last_gap)
+            if self.requested is not None:
+                first_audio_seconds.observe(
+                    time.perf_counter() - self.requested)
+                self.requested = None
+            self.refresh_prefetch()
+            self._spawner = self.bot.loop.create_task(self._spawn_next())
+            audio_cache.played(source.web_url, self._guild.id)
+            if LIVE_NP:
+                template = np_template(source, self.bot)
+                self.np = await outbound.send(self._channel, embed=np_progress(template, source))
+                self._np_live = self.bot.loop.create_task(
+                    self._update_np(template))
+            else:
+                embed = discord.Embed(
+                    title="Now playing", description=f"[{source.title}]({source.web_url}) [{source.requester.mention}]", color=discord.Color.green())
+                self.np = await outbound.send(self._channel, embed=embed)
+
+            await self.next.wait()
+            while self._interrupted() and await self._resume():
+                await self.next.wait()
+            if self._spawner is not None:
+                self._spawner.cancel()
+                self._spawner = None  # The spawned source itself is kept for the next song
+
+            self.stop_np()
+            # Make sure the FFmpeg process is cleaned up. The source may have been restarted meanwhile.
+            self.current.cleanup()
+            self.current = None
+
+    async def _update_np(self, template):
+        """Edit the now playing message every live_np seconds. Nothing is sent while the
+        progress shown doesn't change, e.g. while paused.
+        """
+        shown = None
+        while True:
+            await asyncio.sleep(LIVE_NP)
+            # self.current is read each time, the source may have been restarted
+            embed = np_progress(template, self.current)
+            fields = [field.value for field in embed.fields]
+            if fields != shown:
+                shown = fields
+                outbound.edit(self.np, embed=embed)
+
+    def stop_np(self):
+        if self._np_live is not None:
+            self._np_live.cancel()
+            self._np_live = None
+
+    def suspend(self):
+        """Pause while nobody is listening, and disconnect if nobody comes back within the grace period.
+        With empty_channel_release the ffmpeg processes are released too, the song restarts where it
+        was when a listener returns.
+        """
+        if self.suspended:
+            return
+        vc = self._guild.voice_client
+        self.suspended = 'idle'
+        self._suspend_timer = self.bot.loop.call_later(
+            EMPTY_CHANNEL_GRACE, self.destroy, self._guild)
+
+        if vc is None or not vc.is_playing():
+            return
+        vc.pause()
+        self.suspended = 'paused'
+        if EMPTY_CHANNEL_RELEASE and self.current is not None and self.current.media is not None:
+            self._suspend_position = self.current.position
+            self.drop_spawned(stop=True)
+            self.current.cleanup()
+
+    def wake(self):
+        """Pick up where suspend() left off once a listener is back."""
+        if not self.suspended:
+            return
+        paused = self.suspended == 'paused'
+        self.suspended = False
+        if self._suspend_timer is not None:
+            self._suspend_timer.cancel()
+            self._suspend_timer = None
+
+        vc = self._guild.voice_client
+        position, self._suspend_position = self._suspend_position, None
+        if not paused or vc is None or not vc.is_paused():
+            return  # Someone resumed it meanwhile, or it was paused by a user
+        if position is not None:
+            try:
+                self.restart(position)
+            except FFmpegLimitError:
+                return self.stop()
+            if self._spawner is None or self._spawner.done():
+                self._spawner = self.bot.loop.create_task(self._spawn_next())
+        vc.resume()
+
+    def teardown(self):
+        """Stop all background work of the player, before it is destroyed."""
+        self.cancel_prefetch()
+        self.cancel_enrich()
+        self.drop_spawned(stop=True)
+        self.stop_np()
+        if self._task is not asyncio.current_task():
+            self._task.cancel()  # It would otherwise keep waiting on a queue nobody fills
+        if self._suspend_timer is not None:
+            self._suspend_timer.cancel()
+            self._suspend_timer = None
+
+    def sources(self):
+        """The sources this player owns: the current one and a pre-spawned next one."""
+        sources = [self.current] if self.current is not None else []
+        if self._spawned is not None:
+            sources.append(self._spawned[1])
+        return sources
+
+    def stop(self):
+        """End the current song on purpose, so it isn't resumed."""
+        vc = self._guild.voice_client
+        if vc is not None:
+            self._stopped = True
+            vc.stop()
+
+    def _interrupted(self):
+        """Whether the current song ended early without being stopped, e.g. its stream dropped."""
+        source = self.current
+        vc = self._guild.voice_client
+        return (not self._stopped and vc is not None and vc.is_connected()
+                and source is not None and source.duration is not None
+                and source.position < source.duration - 2)
+
+    async def _resume(self):
+        """Reconnect the current song where it dropped off. Returns False when giving up."""
+        old = self.current
+        if self._resumes >= MAX_RESUMES or old.media is None:
+            return False
+        self._resumes += 1
+        self.next.clear()
+
+        media, data = old.media, old.data
+        if not os.path.exists(media):
+            # The stream URL may be what broke, resolve it again
+            stream_cache.invalidate(old.web_url)
+            try:
+                data = await YTDLSource.resolve_stream(Track(old.web_url, old.title, old.requester, old.duration),
+                                                       loop=self.bot.loop)
+            except Exception:
+                return False
+            media = data['url']
+
+        vc = self._guild.voice_client
+        if vc is None or not vc.is_connected() or self.current is not old:
+            return False
+        try:
+            source = YTDLSource.from_media(media, data=data, requester=old.requester, volume=self.volume,
+                                          start=old.position)
+        except FFmpegLimitError as e:
+            await self._channel.send(f'Connection dropped and could not resume: {e}')
+            return False
+        self.current = source
+        old.cleanup()
+        vc.play(source, after=lambda _: self.bot.loop.call_soon_threadsafe(
+            self._song_ended))
+        await self._channel.send(f'Connection dropped, resuming at `{datetime.timedelta(seconds=round(old.position))}`')
+        return True
+
+    def restart(self, start=None):
+        """Restart the current song at start, by default where it is now, with the current volume.
+        The new ffmpeg process is swapped in without ending the song.
+        Returns False when there is no song to restart right now, e.g. while it is being resumed.
+        Raises FFmpegLimitError if no new ffmpeg process may be started.
+        """
+        vc = self._guild.voice_client
+        old = self.current
+        if old is None or old.media is None or vc is None or vc.source is not old:
+            return False
+
+        new = YTDLSource.from_media(old.media, data=old.data, requester=old.requester, volume=self.volume,
+                                    start=old.position if start is None else start)
+        self.current = new
+        paused = vc.is_paused()
+        vc.source = new  # This resumes playback
+        if paused:
+            vc.pause()
+        old.cleanup()
+        return True
+
+    def destroy(self, guild):
+        """Disconnect and cleanup the player."""
+        return self.bot.loop.create_task(self._cog.cleanup(guild))
+
+
+QUEUE_PAGE_SIZE = 8  # Keeps a page well under Discord's embed description limit
+
+
+class Music(commands.Cog):
+    """Music related commands."""
+
+    __slots__ = ('bot', 'players', 'hibernated')
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.players = {}
+        self.hibernated = {}  # guild id -> PlayerState
+
+        supervisor.live_sources = self.live_sources
+        if bot.is_ready():
+            self.warm_up()  # Loaded after startup
+
+    def live_sources(self):
+        return [source for player in self.players.values() for source in player.sources()]
+
+    def warm_up(self):
+        """Load the extractor in the background, so the first !play doesn't wait for it."""
+        scheduler.warm_up()
+        future = scheduler.run(_warm_up, priority=PRIORITY_BACKGROUND)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def cog_unload(self):
+        for player in list(self.players.values()):
+            self.bot.loop.create_task(self.cleanup(player._guild))
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.warm_up()
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """Suspend a guild's player when the last listener leaves its channel, and wake it when one joins."""
+        if before.channel == after.channel:
+            return
+        vc = member.guild.voice_client
+        player = self.players.get(member.guild.id)
+        if vc is None or player is None or vc.channel is None:
+            return
+
+        if any(not m.bot for m in vc.channel.members):
+            player.wake()
+        else:
+            player.suspend()
+
+    async def cleanup(self, guild):
+        player = self.players.get(guild.id)
+        if player is not None:
+            player.teardown()
+
+        try:
+            await guild.voice_client.disconnect()
+        except AttributeError:
+            pass
+
+        try:
+            del self.players[guild.id]
+        except KeyError:
+            pass
+
+        state = self.hibernated.pop(guild.id, None)
+        if state is not None:
+            state.timer.cancel()
+
+    async def __local_check(self, ctx):
+        """A local check which applies to all commands in this cog."""
+        if not ctx.guild:
+            raise commands.NoPrivateMessage
+        return True
+
+    async def __error(self, ctx, error):
+        """A local error handler for all errors arising from commands in this cog."""
+        if isinstance(error, commands.NoPrivateMessage):
+            try:
+                return await ctx.send('This command can not be used in Private Messages.')
+            except discord.HTTPException:
+                pass
+        elif isinstance(error, InvalidVoiceChannel):
+            await ctx.send('Error connecting to Voice Channel. '
+                           'Please make sure you are in a valid channel or provide me with one')
+
+        print('Ignoring exception in command {}:'.format(
+            ctx.command), file=sys.stderr)
+        traceback.print_exception(
+            type(error), error, error.__traceback__, file=sys.stderr)
+
+    def get_player(self, ctx, create=True):
+        """Retrieve the guild player, or generate one.
+        With create=False this is a plain lookup, returning None for idle guilds.
+        A hibernated player is brought back to life with its settings.
+        """
+        try:
+            player = self.players[ctx.guild.id]
+        except KeyError:
+            if not create:
+                return None
+            state = self.hibernated.pop(ctx.guild.id, None)
+            if state is not None:
+                state.timer.cancel()
+            player = MusicPlayer(ctx, state=state)
+            self.players[ctx.guild.id] = player
+
+        return player
+
+    def hibernate(self, guild, player):
+        """Replace an idle player with a PlayerState, and disconnect later if it stays idle."""
+        if self.players.get(guild.id) is not player:
+            return
+        player.teardown()
+        del self.players[guild.id]
+
+        timer = self.bot.loop.call_later(max(IDLE_TIMEOUT - HIBERNATE_AFTER, 0),
+                                         lambda: self.bot.loop.create_task(self.cleanup(guild)))
+        self.hibernated[guild.id] = PlayerState(player.volume, timer)
+
+    @commands.command(name='join', aliases=['connect', 'j'], description="connects to voice")
+    async def connect_(self, ctx, *, channel: discord.VoiceChannel = None):
+        """Connect to voice.
+        Parameters
+        ------------
+        channel: discord.VoiceChannel [Optional]
+            The channel to connect to. If a channel is not specified, an attempt to join the voice channel you are in
+            will be made.
+        This command also handles moving the bot to different channels.
+        """
+        if not channel:
+            try:
+                channel = ctx.author.voice.channel
+            except AttributeError:
+                embed = discord.Embed(
+                    title="", description="No channel to join. Please call `,join` from a voice channel.", color=discord.Color.green())
+                await ctx.send(embed=embed)
+                raise InvalidVoiceChannel(
+                    'No channel to join. Please either specify a valid channel or join one.')
+
+        vc = ctx.voice_client
+
+        if vc:
+            if vc.channel.id == channel.id:
+                return
+            try:
+                await vc.move_to(channel)
+            except asyncio.TimeoutError:
+                raise VoiceConnectionError(
+                    f'Moving to channel: <{channel}> timed out.')
+        else:
+            try:
+                await channel.connect()
+            except asyncio.TimeoutError:
+                raise VoiceConnectionError(
+                    f'Connecting to channel: <{channel}> timed out.')
+        if (random.randint(0, 1) == 0):
+            await ctx.message.add_reaction('👍')
+        await ctx.send(f'**Joined `{channel}`**')
+
+    # ANCHOR PLAY
+    @commands.command(name='play', aliases=['sing', 'p'], description="streams music")
+    async def play_(self, ctx, *, search: str):
+        """Request a song and add it to the queue.
+        This command attempts to join a valid voice channel if the bot is not already in one.
+        Uses YTDL to automatically search and retrieve a song.
+        Parameters
+        ------------
+        search: str [Required]
+            The song to search and retrieve using YTDL. This could be a simple search, an ID or URL.
+        """
+        requested = time.perf_counter()
+        await ctx.trigger_typing()
+
+        vc = ctx.voice_client
+
+        if not vc:
+            await ctx.invoke(self.connect_)
+
+        player = self.get_player(ctx)
+        if player.current is None and not player.queue:
+            player.requested = requested
+
+        # If download is False, source will be a Track (or a playlist dict) which will be used later to regather the stream.
+        # If download is True, source will be a playable YTDLSource or OpusSource.
+        source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop, download=False)
+
+        if isinstance(source, Track):
+            player.queue.put(source)
+            player.refresh_prefetch()
+            player.enrich([source])
+        else:
+            # It's a playlist, the first song is queued right away and the rest streams in.
+            self.bot.loop.create_task(
+                self._queue_playlist(ctx, player, source))
+
+    async def _queue_playlist(self, ctx, player, data):
+        """Queue the songs of a playlist as they are extracted."""
+        count = 0
+        try:
+            async for songs in YTDLSource.iter_playlist(data, loop=self.bot.loop, guild_id=ctx.guild.id):
+                if self.players.get(ctx.guild.id) is not player:
+                    return  # The player was destroyed meanwhile
+                tracks = [Track(song['webpage_url'], song['title'], ctx.author, song['duration'])
+                          for song in songs]
+                player.queue.extend(tracks)
+                player.enrich(tracks)
+                count += len(songs)
+                player.refresh_prefetch()
+        except Exception as e:
+            await ctx.send(f'There was an error queueing the playlist.\n'
+                           f'```css\n[{e}]\n```')
+
+        if 'playlist' in data:
+            embed = discord.Embed(
+                title="", description=f"Finished queueing {count} songs from [{data['title']}]({data['webpage_url']})", color=discord.Color.green())
+            await ctx.send(embed=embed)
+
+    # ANCHOR PAUSE
+    @commands.command(name='pause', description="pauses music")
+    async def pause_(self, ctx):
+        """Pause the currently playing song."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_playing():
+            embed = discord.Embed(
+                title="", description="I am currently not playing anything", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+        elif vc.is_paused():
+            return
+
+        vc.pause()
+        await ctx.send("Paused ⏸️")
+
+    # ANCHOR RESUME
+    @commands.command(name='resume', description="resumes music")
+    async def resume_(self, ctx):
+        """Resume the currently paused song."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+        elif not vc.is_paused():
+            return
+
+        vc.resume()
+        await ctx.send("Resuming ⏯️")
+
+    # ANCHOR SKIP
+    @commands.command(name='skip', aliases=['next'], description="skips to next song in queue")
+    async def skip_(self, ctx):
+        """Skip the song."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        if vc.is_paused():
+            pass
+        elif not vc.is_playing():
+            return
+
+        player = self.get_player(ctx, create=False)
+        if player is not None:
+            player.stop()
+        else:
+            vc.stop()
+
+    # ANCHOR SEEK
+    @commands.command(name='seek', aliases=['jump'], description="jumps to a position in the song")
+    async def seek_(self, ctx, *, position: str):
+        """Jump to a position in the current song.
+        Parameters
+        ------------
+        position: str [Required]
+            Where to jump to, in seconds or as mm:ss or hh:mm:ss.
+        """
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player = self.get_player(ctx, create=False)
+        if not player or not player.current:
+            embed = discord.Embed(
+                title="", description="I am currently not playing anything", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        try:
+            seconds = 0
+            for part in position.split(':'):
+                seconds = seconds * 60 + float(part)
+        except ValueError:
+            seconds = -1
+        if seconds < 0 or (player.current.duration and seconds >= player.current.duration):
+            embed = discord.Embed(
+                title="", description=f'"{position}" is not a position in this song', color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        try:
+            restarted = player.restart(seconds)
+        except FFmpegLimitError as e:
+            embed = discord.Embed(
+                title="Error!", description=str(e), color=discord.Color.red())
+            return await ctx.send(embed=embed)
+        if not restarted:
+            embed = discord.Embed(
+                title="", description="Can't jump in the song right now, try again in a moment", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+        await ctx.send(f'Jumped to `{datetime.timedelta(seconds=round(seconds))}` ⏩')
+
+    # ANCHOR REMOVE
+    @commands.command(name='remove', aliases=['rm', 'rem'], description="removes specified song from queue")
+    async def remove_(self, ctx, pos: int = None):
+        """Removes specified song from queue"""
+
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player = self.get_player(ctx, create=False)
+        if pos == None:
+            if player and not player.queue.empty():
+                player.queue.pop()
+                player.refresh_prefetch()
+        else:
+            try:
+                if pos < 1 or not player:
+                    raise IndexError(pos)
+                s = player.queue.pop(pos-1)
+                player.refresh_prefetch()
+                embed = discord.Embed(
+                    title="", description=f"Removed [{s.title}]({s.webpage_url}) [{s.requester.mention}]", color=discord.Color.green())
+                await ctx.send(embed=embed)
+            except IndexError:
+                embed = discord.Embed(
+                    title="", description=f'Could not find a track for "{pos}"', color=discord.Color.green())
+                await ctx.send(embed=embed)
+
+    # ANCHOR CLEAR
+    @commands.command(name='clear', aliases=['clr', 'cl', 'cr'], description="clears entire queue")
+    async def clear_(self, ctx):
+        """Deletes entire queue of upcoming songs."""
+
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player = self.get_player(ctx, create=False)
+        if player:
+            player.queue.clear()
+            player.cancel_enrich()
+            player.drop_spawned()
+            player.refresh_prefetch()
+        await ctx.send('**Cleared**')
+
+    # ANCHOR SHUFFLE
+    @commands.command(name='shuffle', aliases=['mix'], description="shuffles the queue")
+    async def shuffle_(self, ctx):
+        """Shuffle the queue of upcoming songs."""
+
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player = self.get_player(ctx, create=False)
+        if not player or player.queue.empty():
+            embed = discord.Embed(
+                title="", description="queue is empty", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player.queue.shuffle()
+        player.refresh_prefetch()
+        await ctx.send('**Shuffled** 🔀')
+
+    # ANCHOR MOVE
+    @commands.command(name='move', aliases=['mv', 'bump'], description="moves a song in the queue")
+    async def move_(self, ctx, pos: int, to: int = 1):
+        """Move a song to another position in the queue.
+        Parameters
+        ------------
+        pos: int [Required]
+            The position of the song to move.
+        to: int [Optional]
+            The position to move it to, the front of the queue by default.
+        """
+
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player = self.get_player(ctx, create=False)
+        if not player or not 0 < pos <= len(player.queue) or not 0 < to <= len(player.queue):
+            embed = discord.Embed(
+                title="", description=f'Could not find a track for "{pos}"', color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        s = player.queue.move(pos-1, to-1)
+        player.refresh_prefetch()
+        embed = discord.Embed(
+            title="", description=f"Moved [{s.title}]({s.webpage_url}) to position {to}", color=discord.Color.green())
+        await ctx.send(embed=embed)
+
+    # ANCHOR DEDUPE
+    @commands.command(name='dedupe', aliases=['dedup', 'unique'], description="removes duplicate songs from queue")
+    async def dedupe_(self, ctx):
+        """Removes songs that are queued more than once, keeping the first."""
+
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player = self.get_player(ctx, create=False)
+        if not player or player.queue.empty():
+            embed = discord.Embed(
+                title="", description="queue is empty", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        removed = player.queue.dedupe()
+        player.refresh_prefetch()
+        embed = discord.Embed(
+            title="", description=f"Removed {removed} duplicate songs", color=discord.Color.green())
+        await ctx.send(embed=embed)
+
+    # ANCHOR QUEUE
+    @commands.command(name='queue', aliases=['q', 'playlist', 'que'], description="shows the queue")
+    async def queue_info(self, ctx, page: int = 1):
+        """Retrieve a page of the queue of upcoming songs.
+        Parameters
+        ------------
+        page: int [Optional]
+            The page of the queue to show, the first one by default.
+        """
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player = self.get_player(ctx, create=False)
+        if not player or player.queue.empty():
+            embed = discord.Embed(
+                title="", description="queue is empty", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        pages = max(1, -(-len(player.queue) // QUEUE_PAGE_SIZE))
+        page = min(max(page, 1), pages)
+
+        embed = discord.Embed(
+            title=f'Queue for {ctx.guild.name}', description=self._queue_page(player, page), color=discord.Color.green())
+        embed.set_footer(text=f"Page {page}/{pages} | {ctx.author.display_name}",
+                         icon_url=ctx.author.avatar_url)
+
+        await ctx.send(embed=embed)
+
+    def _queue_page(self, player, page):
+        """Render a page of the queue. Pages are cached until the queue or the current song changes."""
+        version = (player.queue.version, id(player.current))
+        if player.pages[0] != version:
+            player.pages = (version, {})
+        cached = player.pages[1].get(page)
+        if cached is not None:
+            return cached
+
+        start = (page - 1) * QUEUE_PAGE_SIZE
+        upcoming = itertools.islice(
+            player.queue, start, start + QUEUE_PAGE_SIZE)
+        fmt = '\n'.join(
+            f"`{i}.` [{_.title[:70]}]({_.webpage_url}) | ` {format_duration(_.duration)} Requested by: {_.requester}`\n" for i, _ in enumerate(upcoming, start + 1))
+
+        total = player.queue.duration
+        current = player.current
+        if current is not None:
+            if current.duration:
+                total += current.duration
+            fmt = f"\n__Now Playing__:\n[{current.title}]({current.web_url}) | ` {format_duration(current.duration)} Requested by: {current.requester}`\n\n__Up Next:__\n" + fmt
+        else:
+            fmt = "\n__Up Next:__\n" + fmt
+
+        unknown = f" (+{player.queue.unknown} of unknown length)" if player.queue.unknown else ""
+        fmt += f"\n**{len(player.queue)} songs in queue | {format_duration(total)} total{unknown}**"
+
+        player.pages[1][page] = fmt
+        return fmt
+
+    # ANCHOR NOW PLAYING
+    @commands.command(name='np', aliases=['song', 'current', 'currentsong', 'playing'], description="shows the current playing song")
+    async def now_playing_(self, ctx):
+        """Display information about the currently playing song."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player = self.get_player(ctx, create=False)
+        if not player or not player.current:
+            embed = discord.Embed(
+                title="", description="I am currently not playing anything", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        embed = np_progress(np_template(
+            player.current, self.bot), player.current)
+        await ctx.send(embed=embed)
+
+    # ANCHOR VOLUME
+    @commands.command(name='volume', aliases=['vol', 'v'], description="changes Kermit's volume")
+    async def change_volume(self, ctx, *, vol: float = None):
+        """Change the player volume.
+        Parameters
+        ------------
+        volume: float or int [Required]
+            The volume to set the player to in percentage. This must be between 1 and 100.
+        """
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I am not currently connected to voice", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        if not vol:
+            embed = discord.Embed(
+                title="", description=f"🔊 **{(vc.source.volume)*100}%**", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        if not 0 < vol < 101:
+            embed = discord.Embed(
+                title="", description="Please enter a value between 1 and 100", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        player = self.get_player(ctx)
+
+        player.volume = vol / 100
+
+        later = ""
+        if isinstance(vc.source, (OpusSource, RemoteAudioSource)):
+            # The volume is part of the ffmpeg command line
+            try:
+                restarted = player.restart()
+            except FFmpegLimitError:
+                restarted = False
+            if not restarted:
+                later = ", from the next song on"
+        elif vc.source:
+            vc.source.volume = vol / 100
+
+        embed = discord.Embed(
+            title="", description=f'**`{ctx.author}`** set the volume to **{vol}%**{later}', color=discord.Color.green())
+        await ctx.send(embed=embed)
+
+    # ANCHOR LEAVE
+    @commands.command(name='leave', aliases=["stop", "dc", "disconnect", "bye"], description="stops music and disconnects from voice")
+    async def leave_(self, ctx):
+        """Stop the currently playing song and destroy the player.
+        !Warning!
+            This will destroy the player assigned to your guild, also deleting any queued songs and settings.
+        """
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            embed = discord.Embed(
+                title="", description="I'm not connected to a voice channel", color=discord.Color.green())
+            return await ctx.send(embed=embed)
+
+        if (random.randint(0, 1) == 0):
+            await ctx.message.add_reaction('👋')
+        await ctx.send('**Successfully disconnected**')
+
+        await self.cleanup(ctx.guild)
+
+    # ANCHOR FFMPEG
+    @commands.command(name='ffmpeg', description="lists the running ffmpeg processes")
+    @commands.is_owner()
+    async def ffmpeg_(self, ctx):
+        """List the running ffmpeg processes and their resource usage."""
+
+        supervisor.sweep()
+        lines = supervisor.report() or ["No ffmpeg processes running"]
+        embed = discord.Embed(
+            title="ffmpeg processes", description="\n".join(lines)[:2048], color=discord.Color.green())
+        embed.set_footer(text=supervisor.stats())
+        await ctx.send(embed=embed)
+
+
+def stats_fields(bot):
+    """The fields this extension adds to !stats."""
+    fields = [("Resolve cache", resolve_cache.stats()),
+              ("Stream cache", stream_cache.stats()),
+              ("Extraction scheduler", scheduler.stats()),
+              ("Coalesced extractions", extractions.stats()),
+              ("Audio cache", audio_cache.stats()),
+              ("ffmpeg", supervisor.stats())]
+    if audio_workers.count:
+        fields.append(("Audio workers", audio_workers.stats()))
+
+    music = bot.get_cog('Music')
+    if music is not None:
+        gaps = [p.last_gap for p in music.players.values()
+                if p.last_gap is not None]
+        gap = f"{sum(gaps) / len(gaps) * 1000:.0f} ms" if gaps else "n/a"
+        fields.append(("Players", f"active: {len(music.players)} | hibernated: {len(music.hibernated)} | "
+                       f"average track gap: {gap}"))
+    return fields
+
+
+def setup(bot):
+    music = Music(bot)
+    bot.add_cog(music)
+
+    metrics.gauge('bot_players', 'Active music players.',
+                  lambda: len(music.players))
+    metrics.gauge('bot_queued_songs', 'Songs queued over all players.',
+                  lambda: sum(len(player.queue) for player in music.players.values()))
+    metrics.gauge('bot_extract_backlog', 'Extraction jobs waiting for a worker.',
+                  lambda: scheduler.depth())
+    metrics.gauge('bot_ffmpeg_processes', 'Running ffmpeg processes.',
+                  lambda: len(supervisor._running()))
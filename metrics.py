@@ -0,0 +1,116 @@
+# Metrics shared by the bot and its extensions.
+import bisect
+import itertools
+import os
+
+# metrics=1 turns on the histograms below and the Prometheus endpoint on metrics_host:metrics_port.
+# Gauges are only evaluated when read, disabled histograms ignore observations.
+METRICS = os.getenv('metrics', '0') == '1'
+
+
+class Histogram:
+    """Prometheus style histogram, with one series of buckets per label value."""
+
+    def __init__(self, name, help, buckets, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        self.series = {}  # Label value -> [count per bucket (the last is +Inf), sum]
+        if not METRICS:
+            self.observe = self._ignore
+
+    def _ignore(self, value, label=None):
+        pass
+
+    def observe(self, value, label=None):
+        series = self.series.get(label)
+        if series is None:
+            series = self.series[label] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def quantile(self, q, label=None):
+        """Upper bound of the bucket holding the q quantile, None without observations."""
+        counts = self.series[label][0]
+        rank = q * sum(counts)
+        for bound, count in zip(self.buckets + [float('inf')], itertools.accumulate(counts)):
+            if count >= rank:
+                return bound
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, (counts, total) in self.series.items():
+            labels = f'{self.label}="{value}",' if self.label else ''
+            for bound, count in zip(self.buckets + ['+Inf'], itertools.accumulate(counts)):
+                lines.append(
+                    f'{self.name}_bucket{{{labels}le="{bound}"}} {count}')
+            labels = f'{{{labels[:-1]}}}' if labels else ''
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {sum(counts)}")
+        return lines
+
+    def summary(self):
+        lines = []
+        for value, (counts, total) in self.series.items():
+            count = sum(counts)
+            name = f"{self.name}{{{value}}}" if value is not None else self.name
+            lines.append(f"{name}: {count} | avg {total / count:.3f}s | "
+                         f"p50 ≤{self.quantile(.5, value)}s | p95 ≤{self.quantile(.95, value)}s")
+        return lines
+
+
+class Metrics:
+    """Registry of histograms and gauges, exposed through !stats and a Prometheus text endpoint."""
+
+    def __init__(self):
+        self.histograms = {}  # Name -> Histogram
+        self.gauges = {}  # Name -> (help, function returning the value)
+        self._runner = None
+
+    # Registering again returns or replaces the existing one, so reloaded extensions don't add duplicates
+    def histogram(self, name, help, buckets, label=None):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(
+                name, help, buckets, label)
+        return histogram
+
+    def gauge(self, name, help, func):
+        self.gauges[name] = (help, func)
+
+    def expose(self):
+        lines = []
+        for name, (help, func) in self.gauges.items():
+            lines += [f"# HELP {name} {help}",
+                      f"# TYPE {name} gauge", f"{name} {func()}"]
+        for histogram in self.histograms.values():
+            lines += histogram.expose()
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        lines = [f"{name}: {func()}" for name, (_, func) in self.gauges.items()]
+        for histogram in self.histograms.values():
+            lines += histogram.summary()
+        return "\n".join(lines)
+
+    async def serve(self, host, port):
+        """Start the /metrics endpoint, once."""
+        if self._runner is not None or not METRICS or not port:
+            return
+        import aiohttp.web
+
+        async def handle(request):
+            return aiohttp.web.Response(text=self.expose(), content_type='text/plain')
+
+        app = aiohttp.web.Application()
+        app.router.add_get('/metrics', handle)
+        self._runner = aiohttp.web.AppRunner(app)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, host, port).start()
+
+
+metrics = Metrics()
+SECONDS = [.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30]
+command_seconds = metrics.histogram(
+    'bot_command_seconds', 'Time to run a command.', SECONDS, 'command')
@@ -0,0 +1,101 @@
+# Outbound message dispatcher, shared by the bot and its extensions.
+import asyncio
+import copy
+import os
+import time
+
+import discord
+
+
+class ChannelBucket:
+    """Token bucket pacing what is sent to one channel, the way Discord rate limits it."""
+
+    __slots__ = ('rate', 'per', 'tokens', 'updated')
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Take a token, return how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens +
+                          (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        delay = max(0.0, (1 - self.tokens) * self.per / self.rate)
+        self.tokens -= 1
+        return delay
+
+
+class Outbound:
+    """Central dispatcher for messages and edits, paced per channel so we wait here instead of
+    running into 429s. Edits to one message that haven't gone out yet are merged, only the
+    latest state is sent.
+    """
+
+    def __init__(self, rate=5, per=5.0):
+        self.rate = rate
+        self.per = per
+        self.buckets = {}  # Channel id -> ChannelBucket
+        self._edits = {}  # Message id -> [latest edit or None, task sending it]
+
+        self.sent = 0
+        self.edits = 0
+        self.applied = 0
+        self.waited = 0.0
+
+    async def _wait(self, channel_id):
+        bucket = self.buckets.get(channel_id)
+        if bucket is None:
+            bucket = self.buckets[channel_id] = ChannelBucket(
+                self.rate, self.per)
+        delay = bucket.delay()
+        if delay:
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+    async def send(self, channel, **kwargs):
+        await self._wait(channel.id)
+        self.sent += 1
+        return await channel.send(**kwargs)
+
+    def edit(self, message, **kwargs):
+        """Queue an edit of message. Returns a task that is done once the latest edit is applied."""
+        self.edits += 1
+        pending = self._edits.get(message.id)
+        if pending is not None:
+            pending[0] = kwargs
+            return pending[1]
+
+        pending = self._edits[message.id] = [kwargs, None]
+        pending[1] = asyncio.get_event_loop().create_task(
+            self._apply(message, pending))
+        return pending[1]
+
+    async def _apply(self, message, pending):
+        try:
+            while pending[0] is not None:
+                await self._wait(message.channel.id)
+                kwargs, pending[0] = pending[0], None
+                self.applied += 1
+                await message.edit(**kwargs)
+        except discord.NotFound:
+            pass  # The message was deleted meanwhile
+        finally:
+            del self._edits[message.id]
+
+    def stats(self):
+        merged = self.edits - self.applied
+        return (f"{self.sent} sent | {self.applied}/{self.edits} edits applied ({merged} merged) | "
+                f"{self.waited:.1f}s paced | {len(self.buckets)} channels")
+
+
+outbound = Outbound(int(os.getenv('channel_rate', 5)),
+                    float(os.getenv('channel_per', 5)))
+
+
+def copy_embed(template):
+    """Copy of a prebuilt embed. Embed.copy() shares the fields with the template."""
+    return discord.Embed.from_dict(copy.deepcopy(template.to_dict()))